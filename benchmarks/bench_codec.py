@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#########################################################################
+#########################################################################
+
+"""
+   File Name: bench_codec.py
+      Author: Wan Ji
+      E-mail: wanji@live.com
+  Created on: Sun Oct 18 22:10:00 2026 CST
+"""
+DESCRIPTION = """
+Compare size, throughput and reconstruction error of the row codecs.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import numpy as np
+
+from dbarray import DBArray
+
+
+def dir_size(path):
+    """ Total size of the files in `path`.
+    """
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def main(args):
+    arr = np.require(np.random.randn(args.nrows, args.ncols), args.dtype)
+    tempdir = tempfile.mkdtemp()
+
+    print '%-8s %10s %10s %12s %12s %10s %10s' % (
+        'codec', 'row bytes', 'disk MB', 'write row/s', 'read row/s',
+        'max err', 'rms err')
+    for codec in ['raw', 'float16', 'int8']:
+        dbpath = os.path.join(tempdir, '%s.db' % codec)
+        dba = DBArray(dbpath, args.dbtype)
+        dba.set_dtype(arr.dtype)
+        dba.set_shape(arr.shape)
+        dba.set_codec(codec)
+
+        start = time.time()
+        with dba.buffered():
+            dba.set_rows(range(args.nrows), arr)
+        write_time = time.time() - start
+
+        v_rid = np.random.permutation(args.nrows)
+        start = time.time()
+        for bstart in range(0, args.nrows, args.batch_size):
+            dba.get_rows(v_rid[bstart:bstart + args.batch_size].tolist())
+        read_time = time.time() - start
+
+        err = dba.tondarray() - arr
+        print '%-8s %10d %10.1f %12.0f %12.0f %10.2e %10.2e' % (
+            codec, dba._row_nbytes(), dir_size(dbpath) / 2.0**20,
+            args.nrows / write_time, args.nrows / read_time,
+            np.abs(err).max(), np.sqrt((err ** 2).mean()))
+        del dba
+
+    os.system('rm -r %s' % tempdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--nrows', type=int, default=100000)
+    parser.add_argument('--ncols', type=int, default=128)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--dbtype', default='lmdb')
+    parser.add_argument('--batch_size', type=int, default=256)
+    sys.exit(main(parser.parse_args()))
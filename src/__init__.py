@@ -1 +1,3 @@
-from dbarray import DBArray
+from dbarray import BaseDBArray, DBArray
+from sharded import ShardedDBArray
+from server import DBArrayServer
@@ -15,7 +15,11 @@ Array stored in DB.
 """
 
 import os
+import json
 from struct import pack, unpack
+from contextlib import contextmanager
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import logging
 
 import numpy as np
@@ -25,6 +29,7 @@ import storage
 DBTYPE = {
     "leveldb":  storage.StorageLevelDB,
     "lmdb":     storage.StorageLMDB,
+    "remote":   storage.StorageRemote,
     # "redis":    storage.StorageRedis,
 }
 DEFAULT_DTYPE = 'lmdb'
@@ -44,79 +49,82 @@ TSTR_NDARRAY = 'nda'
 TSTR_INT = 'int'
 TSTR_STR = 'str'
 
-
-class DBArray(object):
-    """ Array stored in database.
-
-    `DBArray` is an 2D array stored in database.
-    The purpose of this class is to provide a way to store and access large
-    array which can not be loaded into memory.
-
-    An associated data-type object describes the format of each element in the
-    array. (The data-type is compact with `numpy`)
+# Prefix of the internal records, attribute names must not start with it
+INTERNAL_PREFIX = '__dbarray__/'
+
+# key and version of the header record holding the array information
+HEADER_KEY = INTERNAL_PREFIX + 'header'
+HEADER_VERSION = 1
+# file naming the DB type, avoids probing the backends on opening
+MARKER_NAME = 'DBARRAY'
+
+# each row is stored as a whole
+LAYOUT_DENSE = 'dense'
+# each row is stored as `int32` indices of the non-zeros (in the flattened
+# row) followed by their values
+LAYOUT_SPARSE = 'sparse'
+LAYOUTS = [LAYOUT_DENSE, LAYOUT_SPARSE]
+SPARSE_INDEX_TYPE = np.int32
+# rows are stored as they are
+CODEC_RAW = 'raw'
+# lossy, rows are stored as `float16`
+CODEC_FLOAT16 = 'float16'
+# lossy, rows are stored as `int8` after the per-row `float32` scale/offset
+CODEC_INT8 = 'int8'
+CODECS = [CODEC_RAW, CODEC_FLOAT16, CODEC_INT8]
+INT8_PARAM_BYTES = 8
+
+# Change tracking, see `DBArray.set_tracking`. Sequence numbers are packed
+# big-endian so that the log keys sort by sequence.
+PACK_SEQ_TYPE = '>Q'
+# last sequence number
+SEQ_KEY = INTERNAL_PREFIX + 'seq'
+# `LOG_PREFIX + seq` -> row key written at `seq`
+LOG_PREFIX = INTERNAL_PREFIX + 'log/'
+LOG_STOP = INTERNAL_PREFIX + 'log0'
+# `VER_PREFIX + row key` -> sequence number of the last write
+VER_PREFIX = INTERNAL_PREFIX + 'ver/'
+DEFAULT_SYNC_BATCH = 1024
+
+# default size limit of the write buffer, see `DBArray.buffered`
+DEFAULT_BUFFER_BYTES = 2**26
+
+
+class BaseDBArray(object):
+    """ Interface of arrays stored in DB.
+
+    Indexing, iteration and conversion are built on `get_rows`, `set_rows`,
+    `get_db_attr` and `set_db_attr`, which are implemented by `DBArray` on a
+    storage and by `sharded.ShardedDBArray` on its shards. The base class
+    holds no storage state.
     """
 
-    def __init__(self, dbpath, dbtype=DEFAULT_DTYPE):
-        """ Initialize the `DBArray`
+    def __init__(self):
+        """ Initialize the array information
 
-        Args:
-            `dbpath`    [str]   path of the database.
-            `dbtype`    [str]   type of the database.
+        Args: N/A
 
         Returns: N/A
         """
 
+        ## Shape of the array, the first axis is the row axis
+        self.shape = (-1, -1)
         ## Number of rows in the array
         self.nrows = -1
-        ## Number of cols in the array
+        ## Shape of each row
+        self.rowshape = (-1, )
+        ## Number of elements in each row (number of cols for 2D array)
         self.ncols = -1
         ## Associated data-type describes the format of each element in the
         # array, which is compact with `numpy`
         self.dtype = None
 
-        is_exists = os.path.exists(dbpath)
-
-        C_Storage = DBTYPE[dbtype]
-        # `dbpath` exists but is not `dbtype`
-        if is_exists and not C_Storage.is_valid(dbpath):
-            logging.warning('`%s` exists but is not `%s`' % (dbpath, dbtype))
-            hit_cnt = 0
-            for othertype in DBTYPE.keys():
-                if othertype == dbtype:
-                    continue
-                logging.warning('TRY type: %s' % othertype)
-                C_Storage = DBTYPE[othertype]
-                if C_Storage.is_valid(dbpath):
-                    logging.warning('HIT! %s' % othertype)
-                    hit_cnt += 1
-            if hit_cnt == 0:
-                logging.fatal(
-                    '`%s` exists but the DB type is unknown!' % dbpath)
-            elif hit_cnt > 1:
-                logging.fatal(
-                    '`%s` exists but matches too many DB types: %d!' %
-                    dbpath, hit_cnt)
-            else:
-                logging.warning(
-                    'Using `%s` instead of `%s`' % (othertype, dbtype))
-
-        self._storage = C_Storage(dbpath)
-
-        # load information from existing DB
-        if is_exists:
-            self._loadinfo()
-        else:
-            self.set_shape((self.nrows, self.ncols))
-            self.set_dtype(self.dtype)
-
-    def __del__(self):
-        """ Destroy the `DBArray`
-
-        Args: N/A
-
-        Returns: N/A
-        """
-        pass
+        ## Storage layout of the rows
+        self.layout = LAYOUT_DENSE
+        ## Codec used to encode the rows
+        self.codec = CODEC_RAW
+        ## Log row writes for `changes_since`
+        self.tracking = False
 
     def __len__(self):
         """ Get number of rows.
@@ -138,16 +146,15 @@ class DBArray(object):
         if type(key) is str:
             return self.get_db_attr(key)
         else:
-            v_rid, v_cid = self._parse_key_for_array(
-                key, self.nrows, self.ncols)
+            v_rid, v_sub = self._parse_key_for_array(key, self.shape)
 
             if None == v_rid:
                 logging.error("Invalid key: %s" % str(key))
                 return None
 
             rows = self.get_rows(v_rid)
-            if None != v_cid:
-                rows = rows[:, v_cid]
+            if None != v_sub:
+                rows = rows[np.ix_(range(len(v_rid)), *v_sub)]
             return rows
 
     def __setitem__(self, key, val):
@@ -170,63 +177,501 @@ class DBArray(object):
                 logging.error("Invalid value: %s" % str(val))
                 return
 
-            v_rid, v_cid = self._parse_key_for_array(
-                key, self.nrows, self.ncols)
+            v_rid, v_sub = self._parse_key_for_array(key, self.shape)
 
             if None == v_rid:
                 logging.error("Invalid key: %s" % str(key))
                 return
 
-            val = val.reshape(len(v_rid), -1)
-
-            if v_cid is None:
-                rows = val
+            if v_sub is None:
+                rows = val.reshape((len(v_rid), ) + self.rowshape)
             else:
                 rows = self.get_rows(v_rid)
-                rows[:, v_cid] = val
+                v_idx = np.ix_(range(len(v_rid)), *v_sub)
+                rows[v_idx] = val.reshape(rows[v_idx].shape)
             self.set_rows(v_rid, rows)
 
+    def get_rows(self, v_rid, out=None):
+        """ Get rows, see `DBArray.get_rows`.
+        """
+        raise Exception('Unimplemented method in %s: get_rows' %
+                        self.__class__.__name__)
+
+    def set_rows(self, v_rid, arr):
+        """ Set rows, see `DBArray.set_rows`.
+        """
+        raise Exception('Unimplemented method in %s: set_rows' %
+                        self.__class__.__name__)
+
+    def get_db_attr(self, key):
+        """ Get DB attribute, see `DBArray.get_db_attr`.
+        """
+        raise Exception('Unimplemented method in %s: get_db_attr' %
+                        self.__class__.__name__)
+
+    def set_db_attr(self, key, val):
+        """ Set DB attribute, see `DBArray.set_db_attr`.
+        """
+        raise Exception('Unimplemented method in %s: set_db_attr' %
+                        self.__class__.__name__)
+
+    def apply_changes(self, stream):
+        """ Apply rows exported by `changes_since` of an array with the
+        same row format.
+
+        Each batch is written in one transaction per storage, the array grows
+        to hold the rows if needed.
+
+        Args:
+            `stream`    [iterator of (`seq`, `v_rid`, `raws`, `fmt`)]
+                Batches from `changes_since`.
+
+        Returns:
+            `seq`       [int, numpy.ndarray or None]
+                Sequence number of the last applied write of the source, to
+                pass to `changes_since` in the next sync.
+        """
+        last_seq = None
+        for seq, v_rid, raws, fmt in stream:
+            if fmt != self._row_format():
+                raise ValueError('Rows of format %s cannot be applied to %s' %
+                                 (fmt, self._row_format()))
+            if v_rid and max(v_rid) >= self.nrows:
+                self.resize(max(v_rid) + 1)
+            v_item = [(rid, rawval) for rid, rawval in zip(v_rid, raws)
+                      if rawval is not None]
+            self.set_raw_rows([rid for rid, rawval in v_item],
+                              [rawval for rid, rawval in v_item])
+            last_seq = seq
+        return last_seq
+
+    def _set_shape(self, shape):
+        """ Set shape related fields without saving them.
+        """
+        self.shape = tuple(int(dim) for dim in shape)
+        self.nrows = self.shape[0]
+        self.rowshape = self.shape[1:]
+        self.ncols = int(np.prod(self.rowshape))
+
+    def _check_csr(self, v_rid, indptr, indices):
+        """ Check that CSR input has a span for each row of `v_rid` and that
+        its column indices are within the rows
+        """
+        if len(indptr) != len(v_rid) + 1:
+            raise ValueError('Expected %d row pointers, got %d' %
+                             (len(v_rid) + 1, len(indptr)))
+        used = indices[indptr[0]:indptr[-1]]
+        if len(used) > 0 and (used.min() < 0 or used.max() >= self.ncols):
+            raise ValueError('Column indices out of range [0, %d)' %
+                             self.ncols)
+
+    def _row_format(self):
+        """ Format of the encoded rows, rows are exchanged by
+        `changes_since` and `apply_changes` only between equal formats
+        """
+        return {
+            'rowshape': list(self.rowshape),
+            'dtype':    None if self.dtype is None else self.dtype.descr,
+            'layout':   self.layout,
+            'codec':    self.codec,
+        }
+
+    def get_row(self, rid):
+        """ Get a row.
+
+        Args:
+            `rid`       [int]           A single row Id.
+
+        Returns:
+            `subarray`  [numpy.ndarray] Row vector specified by `rid`.
+        """
+        return self.get_rows([rid])[0]
+
+    def batches(self, batch_size, shuffle=True, seed=None, prefetch=2,
+                workers=1):
+        """ Iterate over the rows in mini-batches.
+
+        Row Ids of each batch are sorted for locality. The next `prefetch`
+        batches are read by `workers` background threads into a pool of
+        preallocated buffers, so the rows yielded are only valid until the
+        next iteration and must be copied to be kept.
+
+        Args:
+            `batch_size`    [int]   Number of rows in each batch.
+            `shuffle`       [bool]  Visit the rows in random order.
+            `seed`          [int]   Seed of the random order.
+            `prefetch`      [int]   Number of batches read in advance.
+            `workers`       [int]   Number of reading threads.
+
+        Returns:
+            `iterator` of (`v_rid`, `subarray`)
+                Row Ids and rows of each batch.
+        """
+        if shuffle:
+            order = np.random.RandomState(seed).permutation(self.nrows)
+        else:
+            order = np.arange(self.nrows)
+        v_batch = [np.sort(order[start:start + batch_size])
+                   for start in range(0, self.nrows, batch_size)]
+
+        # batch `bid` is read into buffer `bid % nbufs`, which is reused
+        # after batch `bid` has been consumed
+        nbufs = prefetch + 1
+        buffers = [np.ndarray((batch_size, ) + self.rowshape, self.dtype)
+                   for bid in range(min(nbufs, len(v_batch)))]
+
+        def load(bid):
+            v_rid = v_batch[bid]
+            out = buffers[bid % nbufs][:len(v_rid)]
+            return v_rid, self.get_rows(v_rid.tolist(), out)
+
+        pool = ThreadPool(workers)
+        pending = deque()
+        next_bid = 0
+        try:
+            for bid in range(len(v_batch)):
+                while next_bid < len(v_batch) and next_bid <= bid + prefetch:
+                    pending.append(pool.apply_async(load, (next_bid, )))
+                    next_bid += 1
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def tondarray(self):
+        """ Load data to `ndarray` from `DBArray`.
+
+        Args: N/A
+
+        Returns:
+            `arr`   [numpy.ndarray]
+        """
+        return self.get_rows(range(self.nrows))
+
+    @classmethod
+    def _parse_key_core(cls, key, stop=0):
+        """ Parse the provided key into list.
+
+        Args:
+            `key`   [int, long, slice or list]
+                Valide key can be of type `int`, `long` or `slice`.
+            `stop`  [int]
+                Upper bound of the keys.
+
+        Returns:
+            `keylist`   [list or None]
+                list of valid keys induced from key.
+        """
+        if type(key) in [int, long]:
+            return [key]
+        elif type(key) is slice:
+            return range(0 if key.start is None else key.start,
+                         stop if key.stop is None else key.stop,
+                         1 if key.step is None else key.step)
+        elif type(key) is list:
+            return key
+        else:
+            logging.warning('Invalid key: %s' % str(key))
+            return None
+
+    @classmethod
+    def _parse_key_for_array(cls, key, shape):
+        """ Parse the provided key into row Ids and indices of other axes.
+
+        Args:
+            `key`   [int, long, slice, list or tuple]
+                Index of the array.
+            `shape` [tuple of int]
+                Shape of the array.
+
+        Returns:
+            `v_rid` [list or None]
+                list of row Ids.
+            `v_sub` [list of lists or None]
+                list of indices of each following axis, `None` if all
+                elements of the rows are selected.
+        """
+        if type(key) is tuple:
+            if len(key) == 0:
+                # no key
+                logging.error("Error: invalid syntax!")
+            elif len(key) == 1:
+                return cls._parse_key_core(key[0], shape[0]), None
+            elif len(key) <= len(shape):
+                v_sub = [cls._parse_key_core(key[i], shape[i])
+                         for i in range(1, len(key))]
+                if None in v_sub:
+                    return None, None
+                return cls._parse_key_core(key[0], shape[0]), v_sub
+            else:
+                # bad key
+                logging.error("Error: too many indices!")
+        else:
+            return cls._parse_key_core(key, shape[0]), None
+
+        # return invalid value by default
+        return None, None
+
+
+class DBArray(BaseDBArray):
+    """ Array stored in database.
+
+    `DBArray` is an N-D array stored in database, each row (a block along the
+    first axis) is stored as one record.
+    The purpose of this class is to provide a way to store and access large
+    array which can not be loaded into memory.
+
+    An associated data-type object describes the format of each element in the
+    array. (The data-type is compact with `numpy`)
+    """
+
+    def __init__(self, dbpath, dbtype=DEFAULT_DTYPE, **options):
+        """ Initialize the `DBArray`
+
+        Args:
+            `dbpath`    [str]   path of the database, or address of the
+                                array for the 'remote' type.
+            `dbtype`    [str]   type of the database.
+            `options`           options of the storage, e.g. `map_size`,
+                                `sync` and `metasync` for 'lmdb', or
+                                `write_buffer_size` and `sync` for 'leveldb'.
+
+        Returns: N/A
+        """
+
+        BaseDBArray.__init__(self)
+
+        ## Sequence number of the last tracked write
+        self._seq = 0
+        ## Rows have been written, the layout and codec are fixed then
+        self._has_rows = False
+
+        ## Pending row writes `{key: bytes}`, `None` if not buffered
+        self._wbuf = None
+        ## Total size of the pending row writes
+        self._wbuf_bytes = 0
+        ## Size limit of the pending row writes
+        self._wbuf_max = DEFAULT_BUFFER_BYTES
+
+        ## Cached attributes `{key: val}`, see `get_db_attr`
+        self._attrs = {}
+
+        if DBTYPE[dbtype].REMOTE:
+            # the DB is created by the server
+            is_exists = True
+            marker_type = dbtype
+        else:
+            is_exists = os.path.exists(dbpath)
+            # the marker file names the DB type, no need to probe the backends
+            marker_type = self._read_marker(dbpath) if is_exists else None
+        if marker_type is not None:
+            dbtype = marker_type
+
+        C_Storage = DBTYPE[dbtype]
+        # `dbpath` exists but is not `dbtype`
+        if marker_type is None and is_exists and \
+                not C_Storage.is_valid(dbpath):
+            logging.warning('`%s` exists but is not `%s`' % (dbpath, dbtype))
+            hit_cnt = 0
+            for othertype in DBTYPE.keys():
+                if othertype == dbtype:
+                    continue
+                logging.warning('TRY type: %s' % othertype)
+                if DBTYPE[othertype].is_valid(dbpath):
+                    logging.warning('HIT! %s' % othertype)
+                    hit_type = othertype
+                    hit_cnt += 1
+            if hit_cnt == 0:
+                logging.fatal(
+                    '`%s` exists but the DB type is unknown!' % dbpath)
+            elif hit_cnt > 1:
+                logging.fatal(
+                    '`%s` exists but matches too many DB types: %d!' %
+                    (dbpath, hit_cnt))
+            else:
+                logging.warning(
+                    'Using `%s` instead of `%s`' % (hit_type, dbtype))
+                dbtype = hit_type
+                C_Storage = DBTYPE[dbtype]
+
+        self._storage = C_Storage(dbpath, **options)
+        if marker_type is None:
+            self._write_marker(dbpath, dbtype)
+
+        # load information from existing DB
+        if is_exists:
+            self._loadinfo()
+        else:
+            self._saveinfo()
+
+    def __del__(self):
+        """ Destroy the `DBArray`
+
+        Args: N/A
+
+        Returns: N/A
+        """
+        pass
+
     def set_shape(self, shape):
         """ Set shape of `DBArray`.
 
         Args:
-            `shape` [tuple of int: (nrows, ncols)]
-                Specify number of rows and cols of `DBArray`.
+            `shape` [tuple of int: (nrows, ...)]
+                Specify shape of `DBArray`, the first axis is the row axis.
+
+        Returns: N/A
+        """
+        self._set_shape(shape)
+        self._saveinfo()
+
+    def resize(self, nrows):
+        """ Change number of rows, the rows beyond `nrows` are deleted.
+
+        New rows read as zeros until written.
+
+        Args:
+            `nrows` [int]   New number of rows.
+
+        Returns: N/A
+        """
+        keys = [pack(PACK_NUM_TYPE, rid) for rid in range(nrows, self.nrows)]
+        if self.tracking and keys:
+            # truncated rows are not exported by `changes_since`, and their
+            # log entries go with their versions
+            ver_keys = [VER_PREFIX + key for key in keys]
+            keys += ver_keys + [LOG_PREFIX + ver for ver in
+                                self.get_raws(ver_keys) if ver is not None]
+        if keys:
+            self.delete_raws(keys)
+        self.set_shape((nrows, ) + self.rowshape)
+
+    def set_tracking(self, tracking):
+        """ Enable or disable change tracking.
+
+        When tracking, each row write gets the next sequence number and is
+        logged, so that `changes_since` can export the rows modified after a
+        sequence number. Only one handle should write a tracked DB, rows
+        written by the clients of `server.DBArrayServer` are numbered by the
+        served array.
+
+        Args:
+            `tracking`  [bool]  Log row writes.
 
         Returns: N/A
         """
-        (self.nrows, self.ncols) = shape
-        self._storage.set('nrows', pack(PACK_NUM_TYPE, shape[0]))
-        self._storage.set('ncols', pack(PACK_NUM_TYPE, shape[1]))
+        self.tracking = bool(tracking)
+        self._saveinfo()
+
+    def changes_since(self, seq, batch_size=DEFAULT_SYNC_BATCH):
+        """ Export the rows written after sequence number `seq`.
+
+        Rows are exported once with their latest value, in the order of their
+        last write. Truncating rows with `resize` is not exported.
+
+        Args:
+            `seq`           [int]   Sequence number of the last synced write,
+                                    0 for all tracked writes.
+            `batch_size`    [int]   Number of logged writes per batch.
+
+        Returns:
+            `iterator` of (`seq`, `v_rid`, `raws`, `fmt`)
+                Sequence number of the last write covered by the batch, Ids
+                and encoded values of the rows, and format of the encoded
+                rows, for `apply_changes`.
+        """
+        self.flush()
+        start = LOG_PREFIX + pack(PACK_SEQ_TYPE, seq + 1)
+        while True:
+            entries = self._storage.scan(start, LOG_STOP, batch_size)
+            if not entries:
+                return
+            keys = [key for logkey, key in entries]
+            vers = self._storage.get_multi([VER_PREFIX + key for key in keys])
+            # skip the writes overwritten later
+            v_key = [key for (logkey, key), ver in zip(entries, vers)
+                     if ver == logkey[len(LOG_PREFIX):]]
+            v_rid = [unpack(PACK_NUM_TYPE, key)[0] for key in v_key]
+            last_seq = unpack(PACK_SEQ_TYPE,
+                              entries[-1][0][len(LOG_PREFIX):])[0]
+            yield last_seq, v_rid, self._storage.get_row_multi(v_key), \
+                self._row_format()
+            if len(entries) < batch_size:
+                return
+            start = entries[-1][0] + '\0'
+
+    def compact(self):
+        """ Reclaim the space of deleted and overwritten rows in storage.
+
+        Args: N/A
+
+        Returns: N/A
+        """
+        self.flush()
+        self._storage.compact()
 
     def set_dtype(self, dtype):
-        """ Set dtype of `DBArray`.
+        """ Set dtype of `DBArray`, before writing any row.
 
         Args:
             `dtype` [str or numpy.dtype]
-                Can be any valid numpy.dtype.
+                Can be any valid numpy.dtype supported by the layout and the
+                codec.
+
+        Returns: N/A
+        """
+        dtype = self._gen_dtype(self._get_dtype_name(dtype))
+        self._check_format(self.layout, self.codec, dtype)
+        self.dtype = dtype
+        self._saveinfo()
+
+    def set_codec(self, codec):
+        """ Set codec used to encode the rows, before writing any row.
+
+        Args:
+            `codec` [str]
+                'raw', or the lossy 'float16' and 'int8' for float arrays.
+                'int8' keeps a scale and an offset for each row.
+
+        Returns: N/A
+        """
+        self._check_format(self.layout, codec, self.dtype)
+        self.codec = codec
+        self._saveinfo()
+
+    def set_layout(self, layout):
+        """ Set storage layout of the rows, before writing any row.
+
+        Args:
+            `layout` [str]
+                'dense', or 'sparse' which stores only the non-zeros of each
+                row and requires the 'raw' codec and a non-structured dtype.
 
         Returns: N/A
         """
-        dtype_str = self._get_dtype_name(dtype)
-        self.dtype = self._gen_dtype(dtype_str)
-        self._storage.set('dtype', dtype_str)
+        self._check_format(layout, self.codec, self.dtype)
+        self.layout = layout
+        self._saveinfo()
 
-    def get_rows(self, v_rid):
+    def get_rows(self, v_rid, out=None):
         """ Get rows from DB.
 
         Args:
             `v_rid` [list of int]
                 A list of row Ids.
+            `out`   [numpy.ndarray]
+                Optional array to store the rows in.
 
         Returns:
             `subarray`  [numpy.ndarray]
                 rows specified by `v_rid`.
         """
         nrows = len(v_rid)
-        resarr = np.ndarray((nrows, self.ncols), self.dtype)
-        for i in range(nrows):
-            resarr[i, :] = self.get_row(v_rid[i])
+        if out is None:
+            resarr = np.ndarray((nrows, ) + self.rowshape, self.dtype)
+        else:
+            resarr = out
+        if nrows > 0:
+            self._decode_rows(self.get_raw_rows(v_rid), resarr)
         return resarr
 
     def set_rows(self, v_rid, arr):
@@ -242,19 +687,62 @@ class DBArray(object):
         """
         nrows = len(v_rid)
         for i in range(nrows):
-            self.set_row(v_rid[i], arr[i, :])
+            self.set_row(v_rid[i], arr[i])
 
-    def get_row(self, rid):
-        """ Get a row.
+    def get_rows_csr(self, v_rid):
+        """ Get rows from DB in CSR format, without dense intermediate for the
+        sparse layout.
+
+        Column indices refer to the flattened rows.
 
         Args:
-            `rid`       [int]           A single row Id.
+            `v_rid` [list of int]
+                A list of row Ids.
 
         Returns:
-            `subarray`  [numpy.ndarray] Row vector specified by `rid`.
+            `indptr`    [numpy.ndarray] Row `i` spans
+                                        `indptr[i]:indptr[i+1]`.
+            `indices`   [numpy.ndarray] Column indices of the non-zeros.
+            `data`      [numpy.ndarray] Values of the non-zeros.
+        """
+        if self.layout == LAYOUT_SPARSE:
+            v_nnz, indices, data = self._parse_sparse(self.get_raw_rows(v_rid))
+        else:
+            rows = self.get_rows(v_rid).reshape(len(v_rid), -1)
+            mask = rows != 0
+            v_nnz = mask.sum(1)
+            indices = np.nonzero(mask)[1].astype(SPARSE_INDEX_TYPE)
+            data = rows[mask]
+        indptr = np.zeros(len(v_rid) + 1, np.int64)
+        np.cumsum(v_nnz, out=indptr[1:])
+        return indptr, indices, data
+
+    def set_rows_csr(self, v_rid, indptr, indices, data):
+        """ Set rows of DB from CSR format, in one bulk write.
+
+        Args:
+            `v_rid`     [list of int]   A list of row Ids.
+            `indptr`    [numpy.ndarray] Row `i` spans
+                                        `indptr[i]:indptr[i+1]`.
+            `indices`   [numpy.ndarray] Column indices of the non-zeros.
+            `data`      [numpy.ndarray] Values of the non-zeros.
+
+        Returns: N/A
         """
-        return np.ndarray(self.ncols, self.dtype,
-                          self._storage.get(pack(PACK_NUM_TYPE, rid)))
+        indices = np.asarray(indices, SPARSE_INDEX_TYPE)
+        self._check_csr(v_rid, indptr, indices)
+        data = np.asarray(data, self.dtype)
+        raws = []
+        for i in range(len(v_rid)):
+            start, end = indptr[i], indptr[i + 1]
+            if self.layout == LAYOUT_SPARSE:
+                raws.append(indices[start:end].tostring() +
+                            data[start:end].tostring())
+            else:
+                row = np.zeros(self.rowshape, self.dtype)
+                row.reshape(-1)[indices[start:end]] = data[start:end]
+                raws.append(self._encode_row(row))
+        self._put_rows(v_rid, raws)
 
     def set_row(self, rid, arr):
         """ Set a row
@@ -265,13 +753,141 @@ class DBArray(object):
 
         Returns: N/A
         """
-        return self._storage.set(pack(PACK_NUM_TYPE, rid), arr.data)
+        return self._put_rows([rid], [self._encode_row(arr)])
+
+    def get_raw_rows(self, v_rid):
+        """ Get encoded rows, pending rows of the write buffer included.
+
+        Together with `set_raw_rows`, `get_raws`, `set_raws` and
+        `delete_raws`, this is how `server.DBArrayServer` serves the array.
+
+        Args:
+            `v_rid` [list of int]
+                A list of row Ids.
+
+        Returns:
+            `raws`  [list of str]
+                Encoded rows, `None` for rows never written.
+        """
+        if self._storage.REMOTE and not self._wbuf and len(v_rid) > 1 and \
+                np.all(np.diff(v_rid) == 1):
+            # contiguous rows are requested as a range
+            return self._storage.get_range(int(v_rid[0]), int(v_rid[-1]) + 1)
+        return self._get_raws([pack(PACK_NUM_TYPE, rid) for rid in v_rid],
+                              self._storage.get_row_multi)
+
+    def set_raw_rows(self, v_rid, raws):
+        """ Set encoded rows in one transaction, logged if tracking.
+
+        Args:
+            `v_rid` [list of int]
+                A list of row Ids.
+            `raws`  [list of str]
+                Rows encoded with the layout and codec of this array.
+
+        Returns: N/A
+        """
+        self._put_rows(v_rid, raws)
+
+    def get_raws(self, keys):
+        """ Get raw records other than rows, e.g. the header and attributes.
+
+        Args:
+            `keys`  [list of str]   Keys of the records.
+
+        Returns:
+            `vals`  [list of str]   Raw values, `None` for missing records.
+        """
+        return self._get_raws(keys, self._storage.get_multi)
+
+    def set_raws(self, items):
+        """ Set raw records other than rows in one transaction.
+
+        The information and attributes cached by this handle are reloaded.
+
+        Args:
+            `items` [list of (str, str)]    `(key, val)` of the records.
+
+        Returns: N/A
+        """
+        items = list(items)
+        self._storage.set_multi(items)
+        for key, val in items:
+            self._attrs.pop(key, None)
+        if HEADER_KEY in [key for key, val in items]:
+            has_rows = self._has_rows
+            self._loadinfo()
+            if has_rows and not self._has_rows:
+                # the writer has not seen the rows written by others
+                self._has_rows = True
+                self._saveinfo()
+
+    def delete_raws(self, keys):
+        """ Delete raw records, rows included, pending writes are dropped.
+
+        Args:
+            `keys`  [list of str]   Keys of the records.
+
+        Returns: N/A
+        """
+        keys = list(keys)
+        if self._wbuf:
+            for key in keys:
+                if key in self._wbuf:
+                    self._wbuf_bytes -= len(self._wbuf.pop(key) or '')
+        self._storage.delete_multi(keys)
+        for key in keys:
+            self._attrs.pop(key, None)
+
+    @contextmanager
+    def buffered(self, max_bytes=DEFAULT_BUFFER_BYTES):
+        """ Buffer row writes in memory within a `with` block.
+
+        Rows written by `set_row` are kept in memory, repeated writes to the
+        same row are coalesced and pending rows are served by `get_row`.
+        The buffer is written to DB in one transaction when it reaches
+        `max_bytes`, when `flush` is called, or on exiting the block.
+        If the block raises, the pending rows are discarded.
+
+        Args:
+            `max_bytes` [int]   Size limit of the buffered rows.
+
+        Returns: N/A
+        """
+        if self._wbuf is not None:
+            # nested: keep the outer buffer
+            yield self
+            return
+
+        self._wbuf = {}
+        self._wbuf_bytes = 0
+        self._wbuf_max = max_bytes
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._wbuf = None
+            self._wbuf_bytes = 0
+
+    def flush(self):
+        """ Write the buffered rows to DB.
+
+        Args: N/A
+
+        Returns: N/A
+        """
+        if not self._wbuf:
+            return
+        self._storage.set_row_multi(self._wbuf.iteritems())
+        self._wbuf = {}
+        self._wbuf_bytes = 0
 
     def set_db_attr(self, key, val):
         """ Set DB attribute.
 
         Args:
-            `key`   [str]   Name of the attribute.
+            `key`   [str]   Name of the attribute, not starting with
+                            '__dbarray__/' which is reserved.
             `val`   [str, int or 1-row numpy.ndarray]
                 Value of the attribute.
                 The following attribute type are supported:
@@ -281,21 +897,25 @@ class DBArray(object):
 
         Returns: N/A
         """
+        if key.startswith(INTERNAL_PREFIX):
+            raise ValueError('Reserved attribute name: %s' % key)
         if type(val) is np.ndarray:
             dtype_str = self._get_dtype_name(val.dtype)
             self.set_db_attr(key + "_dtype", dtype_str)
-            return self._storage.set(key, TSTR_NDARRAY +
-                                     val.tostring())
+            self._storage.set(key, TSTR_NDARRAY + val.tostring())
+            val = val.copy()
         elif type(val) is int:
-            return self._storage.set(key, TSTR_INT +
-                                     pack(PACK_NUM_TYPE, val))
+            self._storage.set(key, TSTR_INT + pack(PACK_NUM_TYPE, val))
         elif type(val) is str:
-            return self._storage.set(key, TSTR_STR + val)
+            self._storage.set(key, TSTR_STR + val)
         else:
             raise TypeError('Unsupported attribute type: %s' % str(type(val)))
+        self._attrs[key] = val
 
     def get_db_attr(self, key):
-        """ Set DB attribute.
+        """ Get DB attribute.
+
+        Attributes are cached by this handle after the first access.
 
         Args:
             `key`   [str]
@@ -305,7 +925,21 @@ class DBArray(object):
             `val`   [str, int or 1-row numpy.ndarray]
                 Value of the attribute.
         """
-        rawval = self._storage.get(key)
+        if key not in self._attrs:
+            self._attrs[key] = self._load_db_attr(key)
+        val = self._attrs[key]
+        if type(val) is np.ndarray:
+            return val.copy()
+        return val
+
+    def _load_db_attr(self, key):
+        """ Load DB attribute from storage.
+        """
+        rawval = None
+        if not key.startswith(INTERNAL_PREFIX):
+            rawval = self._storage.get(key)
+        if rawval is None:
+            raise KeyError('Unknown attribute: %s' % key)
         # ndarray: `attr_dtype` is stored in `$key'_dtype'`
         if rawval[:len(TSTR_NDARRAY)] == TSTR_NDARRAY:
             attr_dtype = self._gen_dtype(
@@ -321,51 +955,243 @@ class DBArray(object):
             return rawval[len(TSTR_STR):]
         # unknown type
         else:
-            raise('Unknown attribute type: %s' % rawval[:8])
+            raise TypeError('Unknown attribute type: %s' % rawval[:8])
 
     @classmethod
-    def fromndarray(cls, arr, dbpath, dbtype=DEFAULT_DTYPE):
+    def fromndarray(cls, arr, dbpath, dbtype=DEFAULT_DTYPE, codec=CODEC_RAW,
+                    **options):
         """ Construct `DBArray` from `ndarray`.
 
         Args:
             `arr`       [numpy.ndarray] The source `ndarray`.
             `dbpath`    [str]   Path of the database.
             `dbtype`    [str]   Type of the database.
+            `codec`     [str]   Codec used to encode the rows.
+            `options`           Options of the storage.
 
         Returns:
             `dba`       [DBArray]
         """
-        dba = DBArray(dbpath, dbtype)
+        dba = DBArray(dbpath, dbtype, **options)
         dba.set_dtype(arr.dtype)
         dba.set_shape(arr.shape)
+        dba.set_codec(codec)
         for rid in range(arr.shape[0]):
-            dba.set_row(rid, arr[rid, :])
+            dba.set_row(rid, arr[rid])
         return dba
 
-    def tondarray(self):
-        """ Load data to `ndarray` from `DBArray`.
+    @classmethod
+    def fromcsr(cls, indptr, indices, data, shape, dbpath,
+                dbtype=DEFAULT_DTYPE, layout=LAYOUT_SPARSE, **options):
+        """ Construct `DBArray` from CSR format.
 
-        Args: N/A
+        Args:
+            `indptr`    [numpy.ndarray] Row `i` spans
+                                        `indptr[i]:indptr[i+1]`.
+            `indices`   [numpy.ndarray] Column indices of the non-zeros.
+            `data`      [numpy.ndarray] Values of the non-zeros.
+            `shape`     [tuple of int]  Shape of the array.
+            `dbpath`    [str]   Path of the database.
+            `dbtype`    [str]   Type of the database.
+            `layout`    [str]   Storage layout of the rows.
+            `options`           Options of the storage.
 
         Returns:
-            `arr`   [numpy.ndarray]
+            `dba`       [DBArray]
         """
-        return self.get_rows(range(self.nrows))
+        dba = DBArray(dbpath, dbtype, **options)
+        dba.set_dtype(data.dtype)
+        dba.set_shape(shape)
+        dba.set_layout(layout)
+        dba.set_rows_csr(range(shape[0]), indptr, indices, data)
+        return dba
+
+    def _get_raws(self, keys, get_multi):
+        """ Get raw values of `keys` from the write buffer, or from storage
+        by `get_multi`
+        """
+        # `flush` may replace the buffer meanwhile in another thread
+        wbuf = self._wbuf
+        if not wbuf:
+            return get_multi(keys)
+        v_miss = [key for key in keys if key not in wbuf]
+        stored = dict(zip(v_miss, get_multi(v_miss)))
+        return [wbuf[key] if key in wbuf else stored[key] for key in keys]
+
+    def _put_rows(self, v_rid, raws):
+        """ Put encoded rows, and log the writes if tracking
+        """
+        items = []
+        # rows written through a server are logged by the served array
+        tracking = self.tracking and not self._storage.REMOTE
+        if tracking:
+            v_key = [pack(PACK_NUM_TYPE, rid) for rid in v_rid]
+            # sequence numbers of the last writes of the rows
+            vers = dict(zip(v_key, self._get_raws(
+                [VER_PREFIX + key for key in v_key], self._storage.get_multi)))
+        for rid, rawval in zip(v_rid, raws):
+            key = pack(PACK_NUM_TYPE, rid)
+            items.append((key, rawval))
+            if tracking:
+                if vers[key] is not None:
+                    # the log keeps only the last write of each row
+                    items.append((LOG_PREFIX + vers[key], None))
+                self._seq += 1
+                seq = pack(PACK_SEQ_TYPE, self._seq)
+                vers[key] = seq
+                items += [(LOG_PREFIX + seq, key), (VER_PREFIX + key, seq)]
+        if tracking and items:
+            items.append((SEQ_KEY, seq))
+        self._put_items(items)
+
+    def _put_items(self, items):
+        """ Put `(key, val)` pairs to the write buffer or storage, `None`
+        values delete the keys
+        """
+        if not self._has_rows:
+            self._has_rows = True
+            # the served array records it for rows written through a server
+            if not self._storage.REMOTE:
+                self._saveinfo()
+        if self._wbuf is None:
+            return self._storage.set_row_multi(items)
+
+        for key, val in items:
+            # `None` deletes the key on flush
+            val = None if val is None else str(val)
+            if key in self._wbuf:
+                self._wbuf_bytes -= len(self._wbuf[key] or '')
+            self._wbuf[key] = val
+            self._wbuf_bytes += len(val or '')
+        if self._wbuf_bytes >= self._wbuf_max:
+            self.flush()
+
+    def _check_format(self, layout, codec, dtype):
+        """ Check that the rows can be stored with `layout`, `codec` and
+        `dtype`
+        """
+        if layout not in LAYOUTS:
+            raise ValueError('Unknown layout: %s' % layout)
+        if codec not in CODECS:
+            raise ValueError('Unknown codec: %s' % codec)
+        if self._has_rows and ((layout, codec) != (self.layout, self.codec) or
+                               dtype != self.dtype):
+            raise ValueError('Layout, codec and dtype are fixed once rows '
+                             'are written')
+        if codec != CODEC_RAW and layout != LAYOUT_DENSE:
+            raise ValueError('Codec `%s` requires the dense layout' % codec)
+        if codec != CODEC_RAW and (dtype is None or dtype.kind != 'f'):
+            raise ValueError('Codec `%s` requires a float dtype' % codec)
+        if layout == LAYOUT_SPARSE and \
+                (dtype is None or dtype.fields is not None):
+            raise ValueError('Layout `%s` requires a non-structured dtype' %
+                             layout)
+
+    def _encode_row(self, arr):
+        """ Encode a row with the layout and codec
+        """
+        if self.layout == LAYOUT_SPARSE:
+            row = np.asarray(arr, self.dtype).reshape(-1)
+            idx = np.flatnonzero(row)
+            return idx.astype(SPARSE_INDEX_TYPE).tostring() + \
+                row[idx].tostring()
+        elif self.codec == CODEC_FLOAT16:
+            return arr.astype(np.float16).tostring()
+        elif self.codec == CODEC_INT8:
+            lo = arr.min()
+            scale = (arr.max() - lo) / 255.0
+            if scale == 0:
+                scale = 1.0
+            code = np.round((arr - lo) / scale) - 128
+            return np.array([scale, lo], np.float32).tostring() + \
+                code.astype(np.int8).tostring()
+        else:
+            return np.ascontiguousarray(arr, self.dtype).data
+
+    def _row_nbytes(self):
+        """ Size of an encoded row, 0 for the sparse layout
+        """
+        if self.layout == LAYOUT_SPARSE:
+            return 0
+        elif self.codec == CODEC_FLOAT16:
+            return self.ncols * 2
+        elif self.codec == CODEC_INT8:
+            return INT8_PARAM_BYTES + self.ncols
+        else:
+            return self.ncols * self.dtype.itemsize
+
+    def _decode_rows(self, raws, resarr):
+        """ Decode a batch of encoded rows into `resarr`
+
+        Missing rows are filled with zeros.
+        """
+        nrows = len(raws)
+        if self.layout == LAYOUT_SPARSE:
+            v_nnz, indices, data = self._parse_sparse(raws)
+            resarr[...] = 0
+            resarr.reshape(nrows, -1)[
+                np.repeat(np.arange(nrows), v_nnz), indices] = data
+            return
+
+        zero = '\0' * self._row_nbytes()
+        blob = ''.join([zero if rawval is None else rawval
+                        for rawval in raws])
+        if self.codec == CODEC_FLOAT16:
+            resarr[...] = np.frombuffer(blob, np.float16).reshape(
+                resarr.shape)
+        elif self.codec == CODEC_INT8:
+            blob = np.frombuffer(blob, np.uint8).reshape(nrows, -1)
+            params = blob[:, :INT8_PARAM_BYTES].copy().view(np.float32)
+            code = blob[:, INT8_PARAM_BYTES:].view(np.int8)
+            resarr.reshape(nrows, -1)[...] = \
+                (code + 128.0) * params[:, 0:1] + params[:, 1:2]
+        else:
+            resarr[...] = np.frombuffer(blob, self.dtype).reshape(
+                resarr.shape)
+
+    def _parse_sparse(self, raws):
+        """ Parse a batch of sparse rows
+
+        Returns:
+            `v_nnz`     [numpy.ndarray] Number of non-zeros of each row.
+            `indices`   [numpy.ndarray] Concatenated indices.
+            `data`      [numpy.ndarray] Concatenated values.
+        """
+        entry_bytes = np.dtype(SPARSE_INDEX_TYPE).itemsize + \
+            self.dtype.itemsize
+        v_nnz = np.array([0 if rawval is None else len(rawval) / entry_bytes
+                          for rawval in raws], np.int64)
+        indices = np.ndarray(v_nnz.sum(), SPARSE_INDEX_TYPE)
+        data = np.ndarray(v_nnz.sum(), self.dtype)
+        pos = 0
+        for rawval, nnz in zip(raws, v_nnz):
+            if nnz == 0:
+                continue
+            indices[pos:pos + nnz] = np.frombuffer(
+                rawval, SPARSE_INDEX_TYPE, nnz)
+            data[pos:pos + nnz] = np.frombuffer(
+                rawval, self.dtype, nnz, nnz * indices.itemsize)
+            pos += nnz
+        return v_nnz, indices, data
 
     @classmethod
     def _get_dtype_name(cls, dtype):
         """ Get the name of data type
+
+        Structured dtypes are named by the JSON form of `dtype.descr`.
         """
         if dtype is None:
             return 'None'
-        elif type(dtype) is type:
-            return dtype.__name__
-        elif type(dtype) is np.dtype:
+        try:
+            dtype = np.dtype(dtype)
+        except TypeError:
+            raise Exception('Unrecognized data type: %s' % str(dtype))
+        if dtype.fields is not None:
+            return json.dumps(dtype.descr)
+        elif dtype.isbuiltin:
             return dtype.name
-        elif type(dtype) is str:
-            return str
         else:
-            raise Exception('Unrecognized data type: %s' % str(dtype))
+            return dtype.str
 
     @classmethod
     def _gen_dtype(cls, dtype_str):
@@ -373,58 +1199,87 @@ class DBArray(object):
         """
         if dtype_str == 'None':
             return None
+        elif dtype_str.startswith('['):
+            return np.dtype(cls._descr_from_json(json.loads(dtype_str)))
         else:
             return np.dtype(dtype_str)
 
+    @classmethod
+    def _descr_from_json(cls, descr):
+        """ Restore the tuples and `str`s of `dtype.descr` loaded from JSON
+        """
+        fields = []
+        for field in descr:
+            name = field[0]
+            name = tuple(map(str, name)) if type(name) is list else str(name)
+            fmt = field[1]
+            fmt = cls._descr_from_json(fmt) if type(fmt) is list else str(fmt)
+            fields.append((name, fmt) + tuple(tuple(sub) for sub in field[2:]))
+        return fields
+
     def _loadinfo(self):
         """ Load information from DB
         """
-        self.nrows = unpack(PACK_NUM_TYPE, self._storage.get('nrows'))[0]
-        self.ncols = unpack(PACK_NUM_TYPE, self._storage.get('ncols'))[0]
-        self.dtype = self._gen_dtype(self._storage.get('dtype'))
+        rawval = self._storage.get(HEADER_KEY)
+        if not rawval:
+            # DB created before the header record was introduced
+            self._set_shape(
+                (unpack(PACK_NUM_TYPE, self._storage.get('nrows'))[0],
+                 unpack(PACK_NUM_TYPE, self._storage.get('ncols'))[0]))
+            self.dtype = self._gen_dtype(self._storage.get('dtype'))
+            self._has_rows = True
+            return
+
+        header = json.loads(rawval)
+        if header['version'] > HEADER_VERSION:
+            raise Exception('Unsupported header version: %d' %
+                            header['version'])
+        if str(header['keyfmt']) != PACK_NUM_TYPE:
+            raise Exception('Unsupported key format: %s' % header['keyfmt'])
+        self._set_shape(header['shape'])
+        self.dtype = self._gen_dtype(str(header['dtype']))
+        self.layout = str(header['layout'])
+        self.codec = str(header['codec'])
+        self.tracking = header.get('tracking', False)
+        # unknown for headers written before the field was introduced
+        self._has_rows = header.get('has_rows', True)
+        # loaded even when not tracking, so that tracking enabled again
+        # continues after the logged writes
+        rawval = self._storage.get(SEQ_KEY)
+        self._seq = 0 if rawval is None else unpack(PACK_SEQ_TYPE, rawval)[0]
+
+    def _saveinfo(self):
+        """ Save information to DB
+        """
+        header = {
+            'version':  HEADER_VERSION,
+            'shape':    list(self.shape),
+            'dtype':    self._get_dtype_name(self.dtype),
+            'layout':   self.layout,
+            'codec':    self.codec,
+            'keyfmt':   PACK_NUM_TYPE,
+            'tracking': self.tracking,
+            'has_rows': self._has_rows,
+        }
+        self._storage.set(HEADER_KEY, json.dumps(header, sort_keys=True))
 
     @classmethod
-    def _parse_key_core(cls, key, stop=0):
-        """ Parse the provided key into list.
-
-        Args:
-            `key`   [int, long, slice or list]
-                Valide key can be of type `int`, `long` or `slice`.
-            `stop`  [int]
-                Upper bound of the keys.
-
-        Returns:
-            `keylist`   [list or None]
-                list of valid keys induced from key.
+    def _read_marker(cls, dbpath):
+        """ Read DB type from the marker file, `None` if unavailable
         """
-        if type(key) in [int, long]:
-            return [key]
-        elif type(key) is slice:
-            return range(0 if key.start is None else key.start,
-                         stop if key.stop is None else key.stop,
-                         1 if key.step is None else key.step)
-        elif type(key) is list:
-            return key
-        else:
-            logging.warning('Invalid key: %s' % str(key))
+        try:
+            with open(os.path.join(dbpath, MARKER_NAME)) as mfile:
+                dbtype = mfile.read().strip()
+        except IOError:
             return None
+        return dbtype if dbtype in DBTYPE else None
 
     @classmethod
-    def _parse_key_for_array(cls, key, stop_rows=0, stop_cols=0):
-        if type(key) is tuple:
-            if len(key) == 0:
-                # no key
-                logging.error("Error: invalid syntax!")
-            elif len(key) == 1:
-                return cls._parse_key_core(key[0], stop_rows), None
-            elif len(key) == 2:
-                return (cls._parse_key_core(key[0], stop_rows),
-                        cls._parse_key_core(key[1], stop_cols))
-            else:
-                # bad key
-                logging.error("Error: too many indices!")
-        else:
-            return cls._parse_key_core(key, stop_rows), None
-
-        # return invalid value by default
-        return None, None
+    def _write_marker(cls, dbpath, dbtype):
+        """ Write DB type to the marker file
+        """
+        try:
+            with open(os.path.join(dbpath, MARKER_NAME), 'w') as mfile:
+                mfile.write(dbtype)
+        except IOError as err:
+            logging.warning('Failed to write marker: %s' % str(err))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#########################################################################
+#########################################################################
+
+"""
+   File Name: server.py
+      Author: Wan Ji
+      E-mail: wanji@live.com
+  Created on: Sun Oct 18 22:40:00 2026 CST
+"""
+DESCRIPTION = """
+Server sharing DBArrays with `StorageRemote` clients.
+"""
+
+import sys
+import socket
+import logging
+import threading
+import argparse
+import SocketServer
+from struct import unpack
+
+from dbarray import DBArray, DEFAULT_DTYPE, PACK_NUM_TYPE
+from storage import REQ_HEAD, RESP_HEAD, RANGE_BODY, \
+    OP_GET, OP_SET, OP_DELETE, OP_RANGE, OP_GET_ROWS, OP_SET_ROWS, \
+    STATUS_OK, STATUS_ERROR, pack_list, unpack_list
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """ Serve the requests of one connection in order.
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        if self.server.address_family == socket.AF_INET:
+            self.connection.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            head = self.rfile.read(REQ_HEAD.size)
+            if len(head) < REQ_HEAD.size:
+                return
+            op, name_len, body_len = REQ_HEAD.unpack(head)
+            name = self.rfile.read(name_len)
+            body = self.rfile.read(body_len)
+            try:
+                status = STATUS_OK
+                resp = self.server.dbserver.dispatch(op, name, body)
+            except Exception as err:
+                logging.warning('Request failed: %s' % str(err))
+                status = STATUS_ERROR
+                resp = str(err)
+            self.wfile.write(RESP_HEAD.pack(status, len(resp)) + resp)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class DBArrayServer(object):
+    """ Server owning `DBArray`s and answering batched row requests.
+
+    Clients open the arrays with `DBArray(server.url(name), 'remote')`, so
+    short-lived clients share the warm DB handles and page cache of the
+    server. Each connection is served by its own thread.
+
+    Requests are served through the raw row and record methods of the arrays
+    (`get_raw_rows`, `set_raw_rows`, `get_raws`, `set_raws`, `delete_raws`),
+    so the served `DBArray` or `ShardedDBArray` keeps its write buffer,
+    attribute cache and change log up to date. Writes to each array are
+    served one at a time, so the sequence numbers of tracked writes are
+    assigned by the served array. No row cache is kept besides the page
+    cache.
+    """
+
+    def __init__(self, address, dbarrays):
+        """ Initialize the `DBArrayServer`
+
+        Args:
+            `address`   [tuple: (host, port) or str]
+                TCP address, port 0 picks a free port, or Unix socket path.
+            `dbarrays`  [dict: {name: DBArray or ShardedDBArray}]
+                Arrays served under their names.
+
+        Returns: N/A
+        """
+        ## Arrays served under their names
+        self.dbarrays = dbarrays
+        ## Lock of each array, held by the writes
+        self.locks = dict((name, threading.Lock()) for name in dbarrays)
+        if type(address) is tuple:
+            self.server = _TCPServer(address, _RequestHandler)
+        else:
+            self.server = _UnixServer(address, _RequestHandler)
+        self.server.dbserver = self
+        ## Address the server is bound to
+        self.address = self.server.server_address
+
+    def url(self, name):
+        """ Get the `dbpath` of array `name` for `StorageRemote`.
+        """
+        if type(self.address) is tuple:
+            return 'tcp://%s:%d#%s' % (self.address[0], self.address[1],
+                                       name)
+        else:
+            return 'unix://%s#%s' % (self.address, name)
+
+    def serve_forever(self):
+        """ Serve until `shutdown` is called.
+        """
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """ Stop `serve_forever` and close the listening socket.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def dispatch(self, op, name, body):
+        """ Process a request on array `name`.
+
+        Returns:
+            `resp`  [str]   Body of the response.
+        """
+        if name not in self.dbarrays:
+            raise KeyError('Unknown array: %s' % name)
+        dba = self.dbarrays[name]
+        if op == OP_GET:
+            return pack_list(dba.get_raws(unpack_list(body)))
+        elif op == OP_SET:
+            items = unpack_list(body)
+            with self.locks[name]:
+                dba.set_raws(zip(items[0::2], items[1::2]))
+            return ''
+        elif op == OP_DELETE:
+            with self.locks[name]:
+                dba.delete_raws(unpack_list(body))
+            return ''
+        elif op == OP_RANGE:
+            start, stop = RANGE_BODY.unpack(body)
+            return pack_list(dba.get_raw_rows(range(start, stop)))
+        elif op == OP_GET_ROWS:
+            return pack_list(dba.get_raw_rows(
+                [unpack(PACK_NUM_TYPE, key)[0] for key in unpack_list(body)]))
+        elif op == OP_SET_ROWS:
+            items = unpack_list(body)
+            with self.locks[name]:
+                dba.set_raw_rows(
+                    [unpack(PACK_NUM_TYPE, key)[0] for key in items[0::2]],
+                    items[1::2])
+            return ''
+        else:
+            raise ValueError('Unknown operation: %d' % op)
+
+
+def main(args):
+    dbarrays = {}
+    for item in args.dbarrays:
+        name, dbpath = item.split('=', 1)
+        dbarrays[name] = DBArray(dbpath, args.dbtype)
+    if args.unix:
+        address = args.unix
+    else:
+        host, port = args.tcp.rsplit(':', 1)
+        address = (host, int(port))
+    server = DBArrayServer(address, dbarrays)
+    for name in sorted(dbarrays):
+        logging.warning('Serving %s' % server.url(name))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('dbarrays', nargs='+', metavar='NAME=DBPATH',
+                        help='arrays to serve')
+    parser.add_argument('--tcp', default='127.0.0.1:7190',
+                        help='TCP address HOST:PORT')
+    parser.add_argument('--unix', help='Unix socket path, instead of TCP')
+    parser.add_argument('--dbtype', default=DEFAULT_DTYPE)
+    sys.exit(main(parser.parse_args()))
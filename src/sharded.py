@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#########################################################################
+#########################################################################
+
+"""
+   File Name: sharded.py
+      Author: Wan Ji
+      E-mail: wanji@live.com
+  Created on: Sun Oct 18 21:30:00 2026 CST
+"""
+DESCRIPTION = """
+Array partitioned by rows across multiple DBs.
+"""
+
+import sys
+import json
+from contextlib import contextmanager
+from threading import Thread
+
+import numpy as np
+
+from dbarray import BaseDBArray, DBArray, DEFAULT_DTYPE, \
+    DEFAULT_BUFFER_BYTES, SPARSE_INDEX_TYPE, CODEC_RAW, HEADER_KEY, \
+    DEFAULT_SYNC_BATCH
+
+# rows are split into contiguous ranges, shard `i` holds rows
+# `[offsets[i], offsets[i+1])`
+PARTITION_RANGE = 'range'
+# row `rid` is stored in shard `rid % nshards` as row `rid // nshards`
+PARTITION_HASH = 'hash'
+
+# attributes describing the partition, stored in every shard
+ATTR_PARTITION = 'shard_partition'
+ATTR_INDEX = 'shard_index'
+ATTR_COUNT = 'shard_count'
+ATTR_OFFSETS = 'shard_offsets'
+
+
+class ShardedDBArray(BaseDBArray):
+    """ Array partitioned by rows across multiple `DBArray`s.
+
+    Each shard is an ordinary `DBArray`, so shards can be built independently
+    (e.g. in different processes or on different hosts) and then put together
+    by `assemble`. Rows of one request are grouped by shard and the shards are
+    read and written in parallel threads. The array holds no storage itself,
+    every access goes through the shards.
+    """
+
+    def __init__(self, dbpaths, dbtype=DEFAULT_DTYPE,
+                 partition=PARTITION_RANGE, workers=None, **options):
+        """ Initialize the `ShardedDBArray`
+
+        Args:
+            `dbpaths`   [list of str]   paths of the shards.
+            `dbtype`    [str]   type of the databases.
+            `partition` [str]   'range' or 'hash', used for new arrays only.
+            `workers`   [int]   number of threads, one per shard by default.
+            `options`           options of the storage of each shard.
+
+        Returns: N/A
+        """
+        if partition not in (PARTITION_RANGE, PARTITION_HASH):
+            raise ValueError('Unknown partition: %s' % partition)
+
+        BaseDBArray.__init__(self)
+
+        ## Underlying `DBArray` of each shard
+        self.shards = [DBArray(dbpath, dbtype, **options)
+                       for dbpath in dbpaths]
+        ## Number of shards
+        self.nshards = len(self.shards)
+        ## Partition method of the rows
+        self.partition = partition
+        ## First row Id of each shard, for range partition
+        self.offsets = np.zeros(self.nshards + 1, np.int64)
+
+        self._set_shape(self.shards[0].shape)
+        self.dtype = self.shards[0].dtype
+        self.layout = self.shards[0].layout
+        self.codec = self.shards[0].codec
+        self.tracking = self.shards[0].tracking
+
+        ## Number of threads accessing the shards
+        self.workers = workers or self.nshards
+
+        # load partition from existing shards
+        try:
+            partition = self.shards[0].get_db_attr(ATTR_PARTITION)
+        except KeyError:
+            return
+        self._load_partition(partition)
+
+    def set_shape(self, shape):
+        """ Set shape of `ShardedDBArray` and split the rows into shards.
+
+        Args:
+            `shape` [tuple of int: (nrows, ...)]
+                Specify shape of `ShardedDBArray`.
+
+        Returns: N/A
+        """
+        self._set_shape(shape)
+        if self.partition == PARTITION_RANGE:
+            chunk = -(-self.nrows // self.nshards)
+            self.offsets = np.minimum(
+                np.arange(self.nshards + 1, dtype=np.int64) * chunk,
+                self.nrows)
+            v_nrows = np.diff(self.offsets)
+        else:
+            v_nrows = [self._hash_nrows(sid, self.nrows)
+                       for sid in range(self.nshards)]
+        for sid, shard in enumerate(self.shards):
+            shard.set_shape((int(v_nrows[sid]), ) + self.rowshape)
+        self._save_partition()
+
+    def resize(self, nrows):
+        """ Change number of rows, the rows beyond `nrows` are deleted.
+
+        For range partition the last shard takes the new rows.
+
+        Args:
+            `nrows` [int]   New number of rows.
+
+        Returns: N/A
+        """
+        if self.partition == PARTITION_RANGE:
+            starts = np.minimum(self.offsets[:-1], nrows)
+            ends = np.minimum(self.offsets[1:], nrows)
+            ends[-1] = nrows
+            v_nrows = ends - starts
+            self.offsets = np.concatenate([[0], np.cumsum(v_nrows)])
+        else:
+            v_nrows = [self._hash_nrows(sid, nrows)
+                       for sid in range(self.nshards)]
+        self._parallel(lambda sid: self.shards[sid].resize(int(v_nrows[sid])),
+                       range(self.nshards))
+        self._set_shape((nrows, ) + self.rowshape)
+        self._save_partition()
+
+    def compact(self):
+        """ Compact all shards in parallel.
+
+        Args: N/A
+
+        Returns: N/A
+        """
+        self._parallel(lambda shard: shard.compact(), self.shards)
+
+    def set_dtype(self, dtype):
+        """ Set dtype of all shards, see `DBArray.set_dtype`.
+
+        Args:
+            `dtype` [str or numpy.dtype]
+                Can be any valid numpy.dtype supported by the layout and the
+                codec.
+
+        Returns: N/A
+        """
+        dtype = DBArray._gen_dtype(DBArray._get_dtype_name(dtype))
+        for shard in self.shards:
+            shard._check_format(shard.layout, shard.codec, dtype)
+        for shard in self.shards:
+            shard.set_dtype(dtype)
+        self.dtype = self.shards[0].dtype
+
+    def set_codec(self, codec):
+        """ Set codec of all shards, see `DBArray.set_codec`.
+        """
+        # check every shard first, so that a refused change leaves all of
+        # them untouched
+        for shard in self.shards:
+            shard._check_format(shard.layout, codec, shard.dtype)
+        for shard in self.shards:
+            shard.set_codec(codec)
+        self.codec = codec
+
+    def set_tracking(self, tracking):
+        """ Set change tracking of all shards, see `DBArray.set_tracking`.
+
+        Each shard numbers its own writes, so the sequence numbers of
+        `changes_since` and `apply_changes` are vectors with one number per
+        shard.
+        """
+        for shard in self.shards:
+            shard.set_tracking(tracking)
+        self.tracking = bool(tracking)
+
+    def changes_since(self, seqs, batch_size=DEFAULT_SYNC_BATCH):
+        """ Export the rows written after sequence numbers `seqs`, shard by
+        shard, see `DBArray.changes_since`.
+
+        Args:
+            `seqs`          [list of int or 0]
+                Sequence number of the last synced write of each shard, 0
+                for all tracked writes.
+            `batch_size`    [int]   Number of logged writes per batch.
+
+        Returns:
+            `iterator` of (`seqs`, `v_rid`, `raws`, `fmt`)
+                `seqs` [numpy.ndarray] holds the sequence number of the last
+                write covered in each shard, the others are as for
+                `DBArray.changes_since`.
+        """
+        if np.isscalar(seqs):
+            if seqs != 0:
+                raise ValueError('Expected one sequence number per shard')
+            seqs = [0] * self.nshards
+        seqs = np.array(seqs, np.int64)
+        if seqs.shape != (self.nshards, ):
+            raise ValueError('Expected %d sequence numbers, got %d' %
+                             (self.nshards, seqs.size))
+        for sid, shard in enumerate(self.shards):
+            for seq, v_lid, raws, fmt in shard.changes_since(int(seqs[sid]),
+                                                             batch_size):
+                seqs[sid] = seq
+                yield seqs.copy(), self._unlocate(sid, v_lid), raws, fmt
+
+    def set_layout(self, layout):
+        """ Set layout of all shards, see `DBArray.set_layout`.
+        """
+        for shard in self.shards:
+            shard._check_format(layout, shard.codec, shard.dtype)
+        for shard in self.shards:
+            shard.set_layout(layout)
+        self.layout = layout
+
+    def get_rows(self, v_rid, out=None):
+        """ Get rows from the shards in parallel.
+
+        Args:
+            `v_rid` [list of int]
+                A list of row Ids.
+            `out`   [numpy.ndarray]
+                Optional array to store the rows in.
+
+        Returns:
+            `subarray`  [numpy.ndarray]
+                rows specified by `v_rid`.
+        """
+        if out is None:
+            resarr = np.ndarray((len(v_rid), ) + self.rowshape, self.dtype)
+        else:
+            resarr = out
+
+        def fetch(task):
+            shard, v_pos, v_lid = task
+            resarr[v_pos] = shard.get_rows(v_lid)
+
+        self._parallel(fetch, self._split(v_rid))
+        return resarr
+
+    def set_rows(self, v_rid, arr):
+        """ Set rows of the shards in parallel.
+
+        Rows of each shard are written in one transaction.
+
+        Args:
+            `v_rid` [list of int]
+                A list of row Ids.
+            `arr`   [numpy.ndarray]
+                Rows specified by `v_rid`.
+
+        Returns: N/A
+        """
+        def store(task):
+            shard, v_pos, v_lid = task
+            with shard.buffered():
+                shard.set_rows(v_lid, arr[v_pos])
+
+        self._parallel(store, self._split(v_rid))
+
+    def get_rows_csr(self, v_rid):
+        """ Get rows from the shards in parallel in CSR format.
+
+        Args:
+            `v_rid` [list of int]
+                A list of row Ids.
+
+        Returns:
+            `indptr`, `indices`, `data`, see `DBArray.get_rows_csr`.
+        """
+        parts = []
+
+        def fetch(task):
+            shard, v_pos, v_lid = task
+            parts.append((v_pos, shard.get_rows_csr(v_lid)))
+
+        self._parallel(fetch, self._split(v_rid))
+
+        v_nnz = np.zeros(len(v_rid), np.int64)
+        for v_pos, (sub_indptr, sub_indices, sub_data) in parts:
+            v_nnz[v_pos] = np.diff(sub_indptr)
+        indptr = np.zeros(len(v_rid) + 1, np.int64)
+        np.cumsum(v_nnz, out=indptr[1:])
+        indices = np.ndarray(indptr[-1], SPARSE_INDEX_TYPE)
+        data = np.ndarray(indptr[-1], self.dtype)
+        for v_pos, (sub_indptr, sub_indices, sub_data) in parts:
+            # entry `k` of row `j` in the shard goes to
+            # `indptr[v_pos[j]] + k - sub_indptr[j]`
+            dst = np.repeat(indptr[v_pos] - sub_indptr[:-1],
+                            np.diff(sub_indptr)) + np.arange(len(sub_data))
+            indices[dst] = sub_indices
+            data[dst] = sub_data
+        return indptr, indices, data
+
+    def set_rows_csr(self, v_rid, indptr, indices, data):
+        """ Set rows of the shards in parallel from CSR format.
+
+        Args:
+            `v_rid`, `indptr`, `indices`, `data`,
+                see `DBArray.set_rows_csr`.
+
+        Returns: N/A
+        """
+        indptr = np.asarray(indptr, np.int64)
+        indices = np.asarray(indices, SPARSE_INDEX_TYPE)
+        self._check_csr(v_rid, indptr, indices)
+        data = np.asarray(data)
+
+        def store(task):
+            shard, v_pos, v_lid = task
+            # entries of the rows of the shard
+            v_nnz = np.diff(indptr)[v_pos]
+            sub_indptr = np.zeros(len(v_pos) + 1, np.int64)
+            np.cumsum(v_nnz, out=sub_indptr[1:])
+            src = np.repeat(indptr[v_pos] - sub_indptr[:-1], v_nnz) + \
+                np.arange(sub_indptr[-1])
+            shard.set_rows_csr(v_lid, sub_indptr, indices[src], data[src])
+
+        self._parallel(store, self._split(v_rid))
+
+    def get_row(self, rid):
+        """ Get a row.
+
+        Args:
+            `rid`       [int]           A single row Id.
+
+        Returns:
+            `subarray`  [numpy.ndarray] Row vector specified by `rid`.
+        """
+        sid, lid = self._locate(rid)
+        return self.shards[sid].get_row(int(lid))
+
+    def set_row(self, rid, arr):
+        """ Set a row
+
+        Args:
+            `rid`   [int]           A single row Id.
+            `arr`   [numpy.ndarray] Row vector specified by `rid`.
+
+        Returns: N/A
+        """
+        sid, lid = self._locate(rid)
+        return self.shards[sid].set_row(int(lid), arr)
+
+    def get_raw_rows(self, v_rid):
+        """ Get encoded rows from the shards in parallel, see
+        `DBArray.get_raw_rows`.
+        """
+        raws = [None] * len(v_rid)
+
+        def fetch(task):
+            shard, v_pos, v_lid = task
+            for pos, rawval in zip(v_pos, shard.get_raw_rows(v_lid)):
+                raws[pos] = rawval
+
+        self._parallel(fetch, self._split(v_rid))
+        return raws
+
+    def set_raw_rows(self, v_rid, raws):
+        """ Set encoded rows of the shards in parallel, see
+        `DBArray.set_raw_rows`.
+
+        Rows of each shard are written in one transaction.
+        """
+        def store(task):
+            shard, v_pos, v_lid = task
+            shard.set_raw_rows(v_lid, [raws[pos] for pos in v_pos])
+
+        self._parallel(store, self._split(v_rid))
+
+    def get_raws(self, keys):
+        """ Get raw records other than rows, see `DBArray.get_raws`.
+
+        The header describes the whole array, attributes are read from the
+        first shard.
+        """
+        vals = self.shards[0].get_raws(keys)
+        for pos, key in enumerate(keys):
+            if key == HEADER_KEY and vals[pos] is not None:
+                header = json.loads(vals[pos])
+                header['shape'] = list(self.shape)
+                vals[pos] = json.dumps(header, sort_keys=True)
+        return vals
+
+    def set_raws(self, items):
+        """ Set raw records other than rows, see `DBArray.set_raws`.
+
+        Only attributes can be set, stored in the first shard.
+        """
+        items = list(items)
+        if HEADER_KEY in [key for key, val in items]:
+            raise ValueError('Shape, dtype, layout and codec of '
+                             '`ShardedDBArray` are set by its own methods')
+        self.shards[0].set_raws(items)
+
+    def delete_raws(self, keys):
+        """ Deleting raw records is not supported, rows are deleted by
+        `resize`.
+        """
+        raise ValueError('Rows of `ShardedDBArray` are deleted by `resize`')
+
+    @contextmanager
+    def buffered(self, max_bytes=DEFAULT_BUFFER_BYTES):
+        """ Buffer row writes of every shard, see `DBArray.buffered`.
+
+        Args:
+            `max_bytes` [int]   Size limit of the buffered rows per shard.
+
+        Returns: N/A
+        """
+        contexts = [shard.buffered(max_bytes) for shard in self.shards]
+        for context in contexts:
+            context.__enter__()
+        exc_info = (None, None, None)
+        try:
+            yield self
+            self.flush()
+        except:
+            # the shards discard their pending rows
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            for context in contexts:
+                context.__exit__(*exc_info)
+
+    def flush(self):
+        """ Write the buffered rows of all shards in parallel.
+
+        Args: N/A
+
+        Returns: N/A
+        """
+        self._parallel(lambda shard: shard.flush(), self.shards)
+
+    def set_db_attr(self, key, val):
+        """ Set DB attribute, stored in the first shard.
+        """
+        return self.shards[0].set_db_attr(key, val)
+
+    def get_db_attr(self, key):
+        """ Get DB attribute, stored in the first shard.
+        """
+        return self.shards[0].get_db_attr(key)
+
+    @classmethod
+    def assemble(cls, dbpaths, dbtype=DEFAULT_DTYPE,
+                 partition=PARTITION_RANGE, workers=None, **options):
+        """ Construct `ShardedDBArray` from independently built `DBArray`s.
+
+        For range partition the rows of the shards are concatenated in the
+        order of `dbpaths`. For hash partition shard `i` must hold the rows
+        `i, i + nshards, ...` of the whole array.
+
+        Args:
+            `dbpaths`   [list of str]   paths of the shards.
+            `dbtype`    [str]   type of the databases.
+            `partition` [str]   'range' or 'hash'.
+            `workers`   [int]   number of threads.
+            `options`           options of the storage of each shard.
+
+        Returns:
+            `sdba`      [ShardedDBArray]
+        """
+        sdba = cls(dbpaths, dbtype, partition, workers, **options)
+        sdba.partition = partition
+        for shard in sdba.shards:
+            if shard.rowshape != sdba.rowshape or shard.dtype != sdba.dtype:
+                raise ValueError('Shards differ in row shape or dtype')
+
+        v_nrows = [shard.nrows for shard in sdba.shards]
+        nrows = sum(v_nrows)
+        if partition == PARTITION_RANGE:
+            sdba.offsets = np.cumsum([0] + v_nrows).astype(np.int64)
+        else:
+            for sid in range(sdba.nshards):
+                if v_nrows[sid] != sdba._hash_nrows(sid, nrows):
+                    raise ValueError('Shard %d has wrong number of rows: %d'
+                                     % (sid, v_nrows[sid]))
+        sdba._set_shape((nrows, ) + sdba.rowshape)
+        sdba._save_partition()
+        return sdba
+
+    @classmethod
+    def fromndarray(cls, arr, dbpaths, dbtype=DEFAULT_DTYPE,
+                    partition=PARTITION_RANGE, workers=None, codec=CODEC_RAW,
+                    **options):
+        """ Construct `ShardedDBArray` from `ndarray`.
+
+        Args:
+            `arr`       [numpy.ndarray] The source `ndarray`.
+            `dbpaths`   [list of str]   Paths of the shards.
+            `dbtype`    [str]   Type of the databases.
+            `partition` [str]   'range' or 'hash'.
+            `workers`   [int]   Number of threads.
+            `codec`     [str]   Codec used to encode the rows.
+            `options`           Options of the storage of each shard.
+
+        Returns:
+            `sdba`      [ShardedDBArray]
+        """
+        sdba = cls(dbpaths, dbtype, partition, workers, **options)
+        sdba.set_dtype(arr.dtype)
+        sdba.set_shape(arr.shape)
+        sdba.set_codec(codec)
+        sdba.set_rows(range(arr.shape[0]), arr)
+        return sdba
+
+    def _parallel(self, func, tasks):
+        """ Run `func` on each of `tasks` in at most `workers` threads.
+
+        The threads are joined before returning, so no reference to the shards
+        outlives the call.
+        """
+        nthreads = min(self.workers, len(tasks))
+        if nthreads <= 1:
+            for task in tasks:
+                func(task)
+            return
+
+        errors = []
+
+        def run(subtasks):
+            try:
+                for task in subtasks:
+                    func(task)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [Thread(target=run, args=(tasks[tid::nthreads], ))
+                   for tid in range(nthreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _locate(self, rid):
+        """ Get shard Id and row Id in the shard of global row Id `rid`.
+
+        For range partition the rows beyond the last offset belong to the last
+        shard, as they do after `resize`.
+        """
+        if self.partition == PARTITION_RANGE:
+            sid = np.minimum(np.searchsorted(self.offsets, rid, 'right') - 1,
+                             self.nshards - 1)
+            return sid, rid - self.offsets[sid]
+        else:
+            return rid % self.nshards, rid // self.nshards
+
+    def _unlocate(self, sid, v_lid):
+        """ Get global row Ids of the rows `v_lid` of shard `sid`.
+        """
+        if self.partition == PARTITION_RANGE:
+            return [int(self.offsets[sid]) + lid for lid in v_lid]
+        else:
+            return [lid * self.nshards + sid for lid in v_lid]
+
+    def _hash_nrows(self, sid, nrows):
+        """ Number of rows in shard `sid` for hash partition.
+        """
+        return max(0, -(-(nrows - sid) // self.nshards))
+
+    def _split(self, v_rid):
+        """ Group row Ids by shard.
+
+        Returns:
+            `tasks` [list of tuple: (shard, v_pos, v_lid)]
+                positions in `v_rid` and row Ids in the shard of each group.
+        """
+        v_sid, v_lid = self._locate(np.asarray(v_rid, np.int64))
+        tasks = []
+        for sid in np.unique(v_sid):
+            v_pos = np.flatnonzero(v_sid == sid)
+            tasks.append((self.shards[sid], v_pos, v_lid[v_pos].tolist()))
+        return tasks
+
+    def _load_partition(self, partition):
+        """ Load partition information from the shards.
+        """
+        self.partition = partition
+        for sid, shard in enumerate(self.shards):
+            if shard.get_db_attr(ATTR_INDEX) != sid or \
+                    shard.get_db_attr(ATTR_COUNT) != self.nshards:
+                raise ValueError('Shard %d is not in place' % sid)
+        v_nrows = [shard.nrows for shard in self.shards]
+        if partition == PARTITION_RANGE:
+            self.offsets = self.shards[0].get_db_attr(ATTR_OFFSETS)
+            if list(np.diff(self.offsets)) != v_nrows:
+                raise ValueError('Shards differ from the stored offsets')
+        self._set_shape((sum(v_nrows), ) + self.shards[0].rowshape)
+
+    def _save_partition(self):
+        """ Save partition information to every shard.
+        """
+        for sid, shard in enumerate(self.shards):
+            shard.set_db_attr(ATTR_PARTITION, self.partition)
+            shard.set_db_attr(ATTR_INDEX, sid)
+            shard.set_db_attr(ATTR_COUNT, self.nshards)
+            if self.partition == PARTITION_RANGE:
+                shard.set_db_attr(ATTR_OFFSETS, self.offsets)
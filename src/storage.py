@@ -15,14 +15,83 @@ The backend storage engine of DBArray
 """
 
 import os
+import shutil
+import socket
+import threading
+from struct import Struct
+from contextlib import contextmanager
+from Queue import Queue, Empty, Full
 import leveldb
 import lmdb
 import logging
 
+# Protocol between `StorageRemote` and `server.DBArrayServer`.
+# Request:  REQ_HEAD (op, len(name), len(body)) + name + body
+# Response: RESP_HEAD (status, len(body)) + body
+# Lists of strings in the bodies are packed by `pack_list`.
+REQ_HEAD = Struct('!BHI')
+RESP_HEAD = Struct('!BI')
+LEN_ITEM = Struct('!I')
+RANGE_BODY = Struct('!qq')
+# Records other than rows (header, attributes)
+# body: keys, response: values
+OP_GET = 1
+# body: key0, val0, key1, val1, ..., response: empty
+OP_SET = 2
+# body: keys, response: empty
+OP_DELETE = 4
+# Encoded rows, read and written through the served array
+# body: RANGE_BODY (start, stop), response: values of the rows
+OP_RANGE = 3
+# body: row keys, response: values of the rows
+OP_GET_ROWS = 5
+# body: row key0, val0, row key1, val1, ..., response: empty
+OP_SET_ROWS = 6
+STATUS_OK = 0
+STATUS_ERROR = 1
+# length of `None` items
+LEN_NONE = 0xFFFFFFFF
+# number of keys per get request sent by `StorageRemote`
+PIPELINE_CHUNK = 256
+# number of requests in flight on a connection
+PIPELINE_DEPTH = 16
+
+
+def pack_list(items):
+    """ Pack a list of strings (or `None`s) into a string
+    """
+    parts = [LEN_ITEM.pack(len(items))]
+    for item in items:
+        if item is None:
+            parts.append(LEN_ITEM.pack(LEN_NONE))
+        else:
+            parts.append(LEN_ITEM.pack(len(item)))
+            parts.append(item)
+    return ''.join(parts)
+
+
+def unpack_list(body):
+    """ Unpack a list of strings (or `None`s) packed by `pack_list`
+    """
+    count = LEN_ITEM.unpack_from(body)[0]
+    pos = LEN_ITEM.size
+    items = []
+    for i in xrange(count):
+        length = LEN_ITEM.unpack_from(body, pos)[0]
+        pos += LEN_ITEM.size
+        if length == LEN_NONE:
+            items.append(None)
+        else:
+            items.append(body[pos:pos + length])
+            pos += length
+    return items
+
 
 class Storage(object):
     """ Basic storage
     """
+    ## The DB is owned by a server instead of living at a local path
+    REMOTE = False
 
     def __init__(self):
         pass
@@ -39,6 +108,59 @@ class Storage(object):
         raise Exception('Unimplemented method in %s: get(%s)' %
                         self.__class__.__name__, str(key))
 
+    def get_multi(self, keys):
+        """ Get values of a list of `keys`, `None` for missing keys
+
+        Backends should override this to read all keys in one transaction.
+        """
+        return [self.get(key) for key in keys]
+
+    def set_multi(self, items):
+        """ Set a list of `(key, val)` pairs, `None` values delete the keys
+
+        Backends should override this to write all pairs in one transaction.
+        """
+        for key, val in items:
+            if val is None:
+                self.delete_multi([key])
+            else:
+                self.set(key, val)
+
+    def delete_multi(self, keys):
+        """ Delete a list of `keys`, missing keys are ignored
+        """
+        raise Exception('Unimplemented method in %s: delete_multi' %
+                        self.__class__.__name__)
+
+    def get_row_multi(self, keys):
+        """ Get encoded rows of a list of row `keys`, see `get_multi`
+
+        Separated from `get_multi` for remote storages, whose server reads
+        the rows through the served array.
+        """
+        return self.get_multi(keys)
+
+    def set_row_multi(self, items):
+        """ Set a list of `(row key, encoded row)` pairs, see `set_multi`
+
+        Separated from `set_multi` for remote storages, whose server writes
+        the rows through the served array.
+        """
+        self.set_multi(items)
+
+    def compact(self):
+        """ Reclaim the space of deleted and overwritten values
+        """
+        raise Exception('Unimplemented method in %s: compact' %
+                        self.__class__.__name__)
+
+    def scan(self, start, stop, limit):
+        """ Get at most `limit` `(key, val)` pairs with `start <= key < stop`
+        in key order
+        """
+        raise Exception('Unimplemented method in %s: scan' %
+                        self.__class__.__name__)
+
     @classmethod
     def is_valid(cls, dbpath):
         raise Exception('Unimplemented method in %s: is_valid(%s)' %
@@ -49,9 +171,17 @@ class StorageLevelDB(Storage):
     """ Storage using LevelDB as backend.
     """
 
-    def __init__(self, dbpath):
+    def __init__(self, dbpath, write_buffer_size=2**30, sync=False):
+        """
+        Args:
+            `dbpath`            [str]   path of the database.
+            `write_buffer_size` [int]   size of the in-memory write buffer.
+            `sync`              [bool]  flush each write to disk.
+        """
         Storage.__init__(self)
-        self.hl_db = leveldb.LevelDB(dbpath, write_buffer_size=2**30)
+        self.sync = sync
+        self.hl_db = leveldb.LevelDB(dbpath,
+                                     write_buffer_size=write_buffer_size)
 
     def __del__(self):
         del self.hl_db
@@ -59,67 +189,446 @@ class StorageLevelDB(Storage):
     def set(self, key, val):
         """ Set `key` to `val`
         """
-        self.hl_db.Put(key, val)
+        self.hl_db.Put(key, val, sync=self.sync)
+
+    def set_multi(self, items):
+        """ Set a list of `(key, val)` pairs in one `WriteBatch`, `None`
+        values delete the keys
+        """
+        batch = leveldb.WriteBatch()
+        for key, val in items:
+            if val is None:
+                batch.Delete(key)
+            else:
+                batch.Put(key, val)
+        self.hl_db.Write(batch, sync=self.sync)
+
+    def delete_multi(self, keys):
+        """ Delete a list of `keys` in one `WriteBatch`
+        """
+        batch = leveldb.WriteBatch()
+        for key in keys:
+            batch.Delete(key)
+        self.hl_db.Write(batch, sync=self.sync)
+
+    def compact(self):
+        """ Compact the whole key range
+        """
+        self.hl_db.CompactRange()
+
+    def scan(self, start, stop, limit):
+        """ Get at most `limit` `(key, val)` pairs with `start <= key < stop`
+        """
+        items = []
+        for key, val in self.hl_db.RangeIter(start, stop):
+            if key >= stop or len(items) >= limit:
+                break
+            items.append((key, val))
+        return items
 
     def get(self, key):
-        """ Get value of `key`
+        """ Get value of `key`, `None` if `key` does not exist
         """
-        return self.hl_db.Get(key)
+        try:
+            return self.hl_db.Get(key)
+        except KeyError:
+            return None
 
     @classmethod
     def is_valid(cls, dbpath):
-        for item in os.listdir(dbpath):
-            if item == 'CURRENT':
-                return True
-        return False
+        return os.path.exists(os.path.join(dbpath, 'CURRENT'))
+
+
+class _RWLock(object):
+    """ Lock held either shared by any number of threads or exclusively by
+    one thread. Threads waiting for the exclusive lock block new shared
+    holders, so that they are not starved by a stream of readers.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        ## Number of threads holding the lock shared
+        self._shared = 0
+        ## Number of threads waiting for the exclusive lock
+        self._waiting = 0
+        ## Whether a thread holds the exclusive lock
+        self._exclusive = False
+
+    @contextmanager
+    def shared(self):
+        """ Hold the lock shared within a `with` block
+        """
+        with self._cond:
+            while self._exclusive or self._waiting:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if not self._shared:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """ Hold the lock exclusively within a `with` block
+        """
+        with self._cond:
+            self._waiting += 1
+            while self._exclusive or self._shared:
+                self._cond.wait()
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
 
 
 class StorageLMDB(Storage):
-    """ Storage using LevelDB as backend.
+    """ Storage using LMDB as backend.
+
+    Handles of the same path in a process share one environment and two
+    locks: `lock` serializes the writes and `compact`, and `rwlock` is held
+    shared by the reads and exclusively while `compact` replaces the
+    environment or the map grows, which LMDB allows only when no
+    transaction of the process is active.
     """
     DB_MAP = {}
+    LOCK_MAP = {}
+    RWLOCK_MAP = {}
 
-    def __init__(self, dbpath, map_size=2**40):
+    def __init__(self, dbpath, map_size=2**40, sync=False, metasync=True,
+                 grow=True):
+        """
+        The options take effect when the environment is opened, i.e. by the
+        first handle of `dbpath` in the process.
+
+        Args:
+            `dbpath`    [str]   path of the database.
+            `map_size`  [int]   initial size of the memory map.
+            `sync`      [bool]  flush to disk on each commit.
+            `metasync`  [bool]  flush meta pages to disk on each commit.
+            `grow`      [bool]  double the map when it is full while writing.
+        """
         Storage.__init__(self)
-        abspath = os.path.abspath(dbpath)
-        if abspath not in StorageLMDB.DB_MAP:
-            StorageLMDB.DB_MAP[abspath] = \
-                lmdb.open(dbpath, map_size=map_size, sync=False)
+        self.dbpath = os.path.abspath(dbpath)
+        self.sync = sync
+        self.metasync = metasync
+        self.grow = grow
+        if self.dbpath not in StorageLMDB.DB_MAP:
+            StorageLMDB.DB_MAP[self.dbpath] = self._open(map_size)
         try:
-            StorageLMDB.DB_MAP[abspath].stat()
+            StorageLMDB.DB_MAP[self.dbpath].stat()
         except lmdb.Error:
-            StorageLMDB.DB_MAP[abspath] = \
-                lmdb.open(dbpath, map_size=map_size, sync=False)
-        self.env = StorageLMDB.DB_MAP[abspath]
+            StorageLMDB.DB_MAP[self.dbpath] = self._open(map_size)
+        self.lock = StorageLMDB.LOCK_MAP.setdefault(self.dbpath,
+                                                    threading.Lock())
+        self.rwlock = StorageLMDB.RWLOCK_MAP.setdefault(self.dbpath,
+                                                        _RWLock())
 
     def __del__(self):
         pass
 
+    @property
+    def env(self):
+        """ Environment of `dbpath`, looked up on each use as `compact`
+        replaces it
+        """
+        return StorageLMDB.DB_MAP[self.dbpath]
+
     def set(self, key, val):
         """ Set `key` to `val`
         """
-        with self.env.begin(write=True) as txt:
-            txt.put(key, val)
+        self._write(lambda txt: txt.put(key, val))
+
+    def set_multi(self, items):
+        """ Set a list of `(key, val)` pairs in one transaction, `None`
+        values delete the keys
+        """
+        items = list(items)
+
+        def put_all(txt):
+            for key, val in items:
+                if val is None:
+                    txt.delete(key)
+                else:
+                    txt.put(key, val)
+        self._write(put_all)
+
+    def delete_multi(self, keys):
+        """ Delete a list of `keys` in one transaction
+        """
+        def delete_all(txt):
+            for key in keys:
+                txt.delete(key)
+        self._write(delete_all)
+
+    def compact(self):
+        """ Replace the DB file with a compacted copy.
+
+        Writes of this process wait until the new environment is open, reads
+        wait while the environment is swapped, and all handles of the DB in
+        this process switch to it. Other processes must not have the DB open.
+        """
+        tmppath = self.dbpath + '.compact'
+        with self.lock:
+            env = self.env
+            if os.path.exists(tmppath):
+                shutil.rmtree(tmppath)
+            os.mkdir(tmppath)
+            # the write transaction also keeps out writers of other processes
+            # while copying
+            txt = env.begin(write=True)
+            try:
+                env.copy(tmppath, compact=True)
+            finally:
+                txt.abort()
+            map_size = env.info()['map_size']
+            with self.rwlock.exclusive():
+                env.close()
+                os.rename(os.path.join(tmppath, 'data.mdb'),
+                          os.path.join(self.dbpath, 'data.mdb'))
+                StorageLMDB.DB_MAP[self.dbpath] = self._open(map_size)
+            shutil.rmtree(tmppath)
 
     def get(self, key):
-        """ Get value of `key`
+        """ Get value of `key`, `None` if `key` does not exist
+        """
+        return self._read(lambda txt: txt.get(key))
+
+    def get_multi(self, keys):
+        """ Get values of a list of `keys` in one transaction
+        """
+        return self._read(lambda txt: [txt.get(key) for key in keys])
+
+    def scan(self, start, stop, limit):
+        """ Get at most `limit` `(key, val)` pairs with `start <= key < stop`
+        """
+        def scan_range(txt):
+            items = []
+            cursor = txt.cursor()
+            if not cursor.set_range(start):
+                return items
+            for key, val in cursor:
+                if key >= stop or len(items) >= limit:
+                    break
+                items.append((key, val))
+            return items
+        return self._read(scan_range)
+
+    @classmethod
+    def is_valid(cls, dbpath):
+        return os.path.exists(os.path.join(dbpath, 'data.mdb'))
+
+    def _open(self, map_size):
+        """ Open the environment
+        """
+        return lmdb.open(self.dbpath, map_size=map_size, sync=self.sync,
+                         metasync=self.metasync)
+
+    def _write(self, func):
+        """ Run `func(txn)` in a write transaction, growing the map when full
         """
-        loop = True
-        while loop:
+        with self.lock:
+            while True:
+                try:
+                    with self.env.begin(write=True) as txt:
+                        func(txt)
+                    return
+                except lmdb.MapFullError:
+                    if not self.grow:
+                        raise
+                    with self.rwlock.exclusive():
+                        map_size = self.env.info()['map_size'] * 2
+                        logging.info('Growing map of %s to %d' %
+                                     (self.dbpath, map_size))
+                        self.env.set_mapsize(map_size)
+
+    def _read(self, func):
+        """ Run `func(txn)` in a read transaction and return its result,
+        the environment is neither replaced nor resized meanwhile
+        """
+        with self.rwlock.shared():
+            while True:
+                try:
+                    with self.env.begin() as txt:
+                        return func(txt)
+                except lmdb.BadRSlotError as err:
+                    logging.warning(err.message)
+
+
+class StorageRemote(Storage):
+    """ Storage served by `server.DBArrayServer`.
+
+    `dbpath` is 'tcp://HOST:PORT#NAME' or 'unix://SOCKET_PATH#NAME', where
+    `NAME` is the name of a `DBArray` owned by the server. Connections are
+    pooled, and batched gets are split into requests which are pipelined on
+    one connection. Each batched set or delete is sent as one request, which
+    the server applies in one transaction.
+    """
+    REMOTE = True
+
+    def __init__(self, dbpath, pool_size=4, timeout=None):
+        Storage.__init__(self)
+        url, self.name = dbpath.rsplit('#', 1)
+        if url.startswith('tcp://'):
+            host, port = url[len('tcp://'):].rsplit(':', 1)
+            self.family = socket.AF_INET
+            self.address = (host, int(port))
+        elif url.startswith('unix://'):
+            self.family = socket.AF_UNIX
+            self.address = url[len('unix://'):]
+        else:
+            raise ValueError('Invalid address: %s' % dbpath)
+        self.timeout = timeout
+        self._pool = Queue(pool_size)
+
+    def __del__(self):
+        while True:
             try:
-                with self.env.begin() as txt:
-                    val = txt.get(key)
-                loop = False
-            except lmdb.BadRSlotError as err:
-                logging.warning(err.message)
-        return val
+                sock, rfile = self._pool.get_nowait()
+            except Empty:
+                break
+            rfile.close()
+            sock.close()
+
+    def set(self, key, val):
+        """ Set `key` to `val`
+        """
+        self.set_multi([(key, val)])
+
+    def get(self, key):
+        """ Get value of `key`, `None` if `key` does not exist
+        """
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        """ Get values of a list of `keys` with pipelined requests
+        """
+        keys = list(keys)
+        bodies = [pack_list(keys[start:start + PIPELINE_CHUNK])
+                  for start in range(0, len(keys), PIPELINE_CHUNK)]
+        vals = []
+        for body in self._call(OP_GET, bodies):
+            vals.extend(unpack_list(body))
+        return vals
+
+    def set_multi(self, items):
+        """ Set a list of `(key, val)` pairs in one request, `None` values
+        delete the keys
+        """
+        self._call(OP_SET, [self._pack_items(items)])
+
+    def delete_multi(self, keys):
+        """ Delete a list of `keys` in one request
+        """
+        self._call(OP_DELETE, [pack_list(list(keys))])
+
+    def get_row_multi(self, keys):
+        """ Get encoded rows of a list of row `keys` with pipelined requests
+        """
+        keys = list(keys)
+        bodies = [pack_list(keys[start:start + PIPELINE_CHUNK])
+                  for start in range(0, len(keys), PIPELINE_CHUNK)]
+        vals = []
+        for body in self._call(OP_GET_ROWS, bodies):
+            vals.extend(unpack_list(body))
+        return vals
+
+    def set_row_multi(self, items):
+        """ Set a list of `(row key, encoded row)` pairs in one request
+        """
+        self._call(OP_SET_ROWS, [self._pack_items(items)])
+
+    def get_range(self, start, stop):
+        """ Get stored rows `start` to `stop - 1`, `None` for missing rows
+        """
+        vals = []
+        bodies = [RANGE_BODY.pack(begin, min(begin + PIPELINE_CHUNK, stop))
+                  for begin in range(start, stop, PIPELINE_CHUNK)]
+        for body in self._call(OP_RANGE, bodies):
+            vals.extend(unpack_list(body))
+        return vals
 
     @classmethod
     def is_valid(cls, dbpath):
-        for item in os.listdir(dbpath):
-            if item.endswith('.mdb'):
-                return True
-        return False
+        return True
+
+    @classmethod
+    def _pack_items(cls, items):
+        """ Pack `(key, val)` pairs as `key0, val0, key1, val1, ...`
+        """
+        flat = []
+        for key, val in items:
+            flat.append(key)
+            flat.append(None if val is None else str(val))
+        return pack_list(flat)
+
+    def _call(self, op, bodies):
+        """ Send requests and receive responses, at most `PIPELINE_DEPTH`
+        requests are in flight.
+        """
+        conn = self._acquire()
+        sock, rfile = conn
+        try:
+            resps = []
+            for sent, body in enumerate(bodies, 1):
+                sock.sendall(REQ_HEAD.pack(op, len(self.name), len(body)) +
+                             self.name + body)
+                if sent - len(resps) >= PIPELINE_DEPTH:
+                    resps.append(self._recv(rfile))
+            while len(resps) < len(bodies):
+                resps.append(self._recv(rfile))
+        except:
+            rfile.close()
+            sock.close()
+            raise
+        self._release(conn)
+
+        for status, body in resps:
+            if status != STATUS_OK:
+                raise Exception('Server error: %s' % body)
+        return [body for status, body in resps]
+
+    @classmethod
+    def _recv(cls, rfile):
+        """ Receive a response
+        """
+        head = rfile.read(RESP_HEAD.size)
+        if len(head) < RESP_HEAD.size:
+            raise IOError('Connection closed by server')
+        status, length = RESP_HEAD.unpack(head)
+        body = rfile.read(length)
+        if len(body) < length:
+            raise IOError('Connection closed by server')
+        return status, body
+
+    def _acquire(self):
+        """ Get a connection from the pool or open a new one
+        """
+        try:
+            return self._pool.get_nowait()
+        except Empty:
+            pass
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rb')
+
+    def _release(self, conn):
+        """ Put a connection back to the pool, close it if the pool is full
+        """
+        try:
+            self._pool.put_nowait(conn)
+        except Full:
+            conn[1].close()
+            conn[0].close()
 
 
 class StorageRedis(Storage):
@@ -18,11 +18,14 @@ import unittest
 
 import os
 import tempfile
+import threading
+from struct import pack
 
 import numpy as np
 import numpy.random as nr
 import lmdb
-from dbarray import DBArray
+from dbarray import BaseDBArray, DBArray, ShardedDBArray, DBArrayServer
+from dbarray.dbarray import HEADER_KEY, LOG_PREFIX, LOG_STOP
 
 
 class CommTestDBArray(object):
@@ -168,6 +171,7 @@ class CommTestDBArray(object):
             self._arr_eq(dba['data_mean'], data_mean)
             self.assertEqual(dba['int_attr'], int_attr)
             self.assertEqual(dba['str_attr'], str_attr)
+            self.assertRaises(KeyError, dba.__getitem__, 'no_attr')
 
             del dba
             dba = DBArray(dbpath, self.DBTYPE)
@@ -176,6 +180,612 @@ class CommTestDBArray(object):
             self.assertEqual(dba['int_attr'], int_attr)
             self.assertEqual(dba['str_attr'], str_attr)
 
+    def test_ndim(self):
+        """ N-D array and structured dtype.
+        """
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_ndim.db')
+        val = np.require(nr.random((20, 4, 5, 3)), np.float32)
+        dba = DBArray.fromndarray(val, dbpath, self.DBTYPE)
+        del dba
+        dba = DBArray(dbpath, self.DBTYPE)
+        self.assertEqual(dba.shape, val.shape)
+        self.assertEqual(dba.ncols, 60)
+        self._arr_eq(dba.tondarray(), val)
+        self._arr_eq(dba[3], val[3:4])
+        self._arr_eq(dba[1:5, 2], val[1:5, 2:3])
+        self._arr_eq(dba[[1, 7], 1:3, :, [0, 2]],
+                     val[[1, 7]][:, 1:3][:, :, :, [0, 2]])
+
+        dba[2:4, 0, [1, 4]] = np.zeros((2, 1, 2, 3), np.float32)
+        val[2:4, 0, [1, 4]] = 0
+        self._arr_eq(dba.tondarray(), val)
+
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_struct.db')
+        dtype = np.dtype([('id', np.int64), ('pos', np.float32, (3, )),
+                          ('name', 'S8')])
+        val = np.zeros((10, 2), dtype)
+        val['id'] = np.arange(20).reshape(10, 2)
+        val['pos'] = nr.random((10, 2, 3))
+        val['name'] = 'abc'
+        dba = DBArray.fromndarray(val, dbpath, self.DBTYPE)
+        del dba
+        dba = DBArray(dbpath, self.DBTYPE)
+        self.assertEqual(dba.dtype, dtype)
+        self.assertTrue(np.array_equal(dba.tondarray(), val))
+        self.assertTrue(np.array_equal(dba[3:5, 1], val[3:5, 1:2]))
+
+    def test_codec(self):
+        """ Lossy codecs.
+        """
+        for key in ['float32', 'float64']:
+            val = self.commdbs[key]
+            for codec, tol in [('float16', 1e-3), ('int8', 0.5 / 255)]:
+                dbpath = os.path.join(self.tempdir, self.DBTYPE,
+                                      'test_codec_%s_%s.db' % (key, codec))
+                dba = DBArray.fromndarray(val, dbpath, self.DBTYPE, codec)
+                with dba.buffered():
+                    dba[3] = val[3]
+                    self.assertTrue(np.abs(dba[3] - val[3]).max() <= tol)
+                del dba
+                dba = DBArray(dbpath, self.DBTYPE)
+                self.assertEqual(dba.codec, codec)
+                self._info_eq(dba, val)
+                arr = dba.tondarray()
+                self.assertEqual(arr.dtype, val.dtype)
+                self.assertTrue(np.abs(arr - val).max() <= tol)
+                self.assertTrue(np.abs(dba[7] - val[7]).max() <= tol)
+
+                # the format is fixed once rows are written
+                self.assertRaises(ValueError, dba.set_codec, 'raw')
+                self.assertRaises(ValueError, dba.set_layout, 'sparse')
+                self.assertRaises(ValueError, dba.set_dtype, 'float16')
+                self.assertEqual(dba.codec, codec)
+                self.assertEqual(dba.dtype, val.dtype)
+                self.assertTrue(np.abs(dba[7] - val[7]).max() <= tol)
+
+            dbpaths = [os.path.join(self.tempdir, self.DBTYPE,
+                                    'test_codec_sharded_%s_%d.db' % (key, i))
+                       for i in range(2)]
+            sdba = ShardedDBArray.fromndarray(val, dbpaths, self.DBTYPE,
+                                              codec='float16')
+            self.assertEqual(sdba.codec, 'float16')
+            self.assertTrue(np.abs(sdba.tondarray() - val).max() <= 1e-3)
+            self.assertRaises(ValueError, sdba.set_codec, 'int8')
+            self.assertRaises(ValueError, sdba.set_dtype, 'int32')
+            self.assertEqual([shard.codec for shard in sdba.shards],
+                             ['float16', 'float16'])
+
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_codec_int.db')
+        dba = self._create_dba(dbpath, (10, 10), np.int32)
+        self.assertRaises(ValueError, dba.set_codec, 'int8')
+        self.assertRaises(ValueError, dba.set_codec, 'int4')
+        dba.set_dtype(np.float32)
+        dba.set_codec('int8')
+        self.assertRaises(ValueError, dba.set_dtype, np.int32)
+        self.assertEqual(dba.dtype, np.float32)
+
+    def test_sparse(self):
+        """ Sparse layout and CSR format.
+        """
+        val = self.commdbs['float32'].copy()
+        val[val < 0.95] = 0
+        val[7] = 0
+        mask = val != 0
+        indptr = np.concatenate([[0], np.cumsum(mask.sum(1))])
+        indices = np.nonzero(mask)[1]
+        data = val[mask]
+
+        def check_csr(csr, v_rid):
+            arr = np.zeros((len(v_rid), val.shape[1]), val.dtype)
+            arr[np.repeat(np.arange(len(v_rid)), np.diff(csr[0])),
+                csr[1]] = csr[2]
+            self._arr_eq(arr, val[v_rid])
+
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_sparse.db')
+        dba = self._create_dba(dbpath, val.shape, val.dtype)
+        dba.set_layout('sparse')
+        dba.set_rows(range(val.shape[0]), val)
+        del dba
+        dba = DBArray(dbpath, self.DBTYPE)
+        self.assertEqual(dba.layout, 'sparse')
+        self._arr_eq(dba.tondarray(), val)
+        self._arr_eq(dba[[3, 7, 1]], val[[3, 7, 1]])
+        check_csr(dba.get_rows_csr([3, 7, 1]), [3, 7, 1])
+        self.assertRaises(ValueError, dba.set_codec, 'float16')
+
+        # structured dtypes cannot be stored sparse
+        dba = self._create_dba(dbpath + '.new', val.shape, val.dtype)
+        dba.set_layout('sparse')
+        self.assertRaises(ValueError, dba.set_dtype, [('a', 'f4')])
+        self.assertEqual(dba.dtype, val.dtype)
+
+        # bulk ingestion from CSR, into both layouts
+        for layout in ['sparse', 'dense']:
+            dbpath = os.path.join(self.tempdir, self.DBTYPE,
+                                  'test_fromcsr_%s.db' % layout)
+            dba = DBArray.fromcsr(indptr, indices, data, val.shape, dbpath,
+                                  self.DBTYPE, layout)
+            self._arr_eq(dba.tondarray(), val)
+            check_csr(dba.get_rows_csr(range(val.shape[0])),
+                      range(val.shape[0]))
+
+            # invalid CSR input is refused before writing
+            self.assertRaises(ValueError, dba.set_rows_csr, [3], [0, 1],
+                              [val.shape[1]], [1])
+            self.assertRaises(ValueError, dba.set_rows_csr, [3], [0, 1],
+                              [-1], [1])
+            self.assertRaises(ValueError, dba.set_rows_csr, [3, 4], [0, 1],
+                              [0], [1])
+            self._arr_eq(dba.tondarray(), val)
+
+        # sharded
+        dbpaths = [os.path.join(self.tempdir, self.DBTYPE,
+                                'test_sparse_sharded_%d.db' % i)
+                   for i in range(3)]
+        sdba = ShardedDBArray(dbpaths, self.DBTYPE, 'hash')
+        sdba.set_dtype(val.dtype)
+        sdba.set_shape(val.shape)
+        sdba.set_layout('sparse')
+        sdba.set_rows_csr(range(val.shape[0]), indptr, indices, data)
+        self._arr_eq(sdba.tondarray(), val)
+        check_csr(sdba.get_rows_csr([50, 3, 7, 1]), [50, 3, 7, 1])
+        self.assertRaises(ValueError, sdba.set_rows_csr, [3, 4], [0, 1, 2],
+                          [0, val.shape[1]], [1, 1])
+        self._arr_eq(sdba.tondarray(), val)
+
+    def test_batches(self):
+        """ Iterate over mini-batches.
+        """
+        val = self.commdbs['int32']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_batches.db')
+        dba = DBArray.fromndarray(val, dbpath, self.DBTYPE)
+
+        for shuffle in [False, True]:
+            v_rid_all = []
+            for v_rid, rows in dba.batches(32, shuffle, seed=7, prefetch=2,
+                                           workers=2):
+                self.assertTrue(len(v_rid) <= 32)
+                self.assertTrue((np.diff(v_rid) > 0).all())
+                self._arr_eq(rows, val[v_rid])
+                v_rid_all.extend(v_rid)
+            self.assertEqual(sorted(v_rid_all), range(val.shape[0]))
+            if not shuffle:
+                self.assertEqual(v_rid_all, range(val.shape[0]))
+
+        # same seed, same order
+        order1 = [v_rid.tolist() for v_rid, rows in dba.batches(10, seed=3)]
+        order2 = [v_rid.tolist() for v_rid, rows in dba.batches(10, seed=3)]
+        self.assertEqual(order1, order2)
+
+        # stop in the middle
+        for v_rid, rows in dba.batches(10, prefetch=4):
+            break
+
+    def test_sharded(self):
+        """ Rows partitioned across shards.
+        """
+        val = self.commdbs['float64']
+        for partition in ['range', 'hash']:
+            dbpaths = [os.path.join(self.tempdir, self.DBTYPE,
+                                    'test_sharded_%s_%d.db' % (partition, i))
+                       for i in range(3)]
+            sdba = ShardedDBArray.fromndarray(val, dbpaths, self.DBTYPE,
+                                              partition)
+            self._info_eq(sdba, val)
+            self._arr_eq(sdba.tondarray(), val)
+            self.assertEqual(sum(shard.nrows for shard in sdba.shards),
+                             val.shape[0])
+
+            del sdba
+            sdba = ShardedDBArray(dbpaths, self.DBTYPE)
+            self.assertEqual(sdba.partition, partition)
+            self._info_eq(sdba, val)
+            self._arr_eq(sdba[[90, 3, 50, 3]], val[[90, 3, 50, 3]])
+            self._arr_eq(sdba[40, 1:3], val[40:41, 1:3])
+
+            sdba[[5, 95]] = val[[95, 5]]
+            self._arr_eq(sdba[[5, 95]], val[[95, 5]])
+            with sdba.buffered():
+                sdba[5] = val[5]
+                sdba[95] = val[95]
+            self._arr_eq(sdba.tondarray(), val)
+
+            # pending rows of all shards are discarded if the block fails
+            def fail(sdba):
+                with sdba.buffered():
+                    sdba[[5, 95]] = val[[95, 5]]
+                    raise ValueError('failed')
+            self.assertRaises(ValueError, fail, sdba)
+            self._arr_eq(sdba.tondarray(), val)
+
+            # rows beyond the end are kept when the array grows over them
+            sdba[val.shape[0] + 2] = val[7]
+            self._arr_eq(sdba[val.shape[0] + 2], val[7:8])
+            sdba.resize(val.shape[0] + 3)
+            self._arr_eq(sdba[val.shape[0]:], np.vstack(
+                [np.zeros((2, ) + val.shape[1:], val.dtype), val[7:8]]))
+            sdba.resize(val.shape[0])
+            self._arr_eq(sdba.tondarray(), val)
+
+            # no storage is inherited from `DBArray`
+            self.assertFalse(isinstance(sdba, DBArray))
+            self.assertTrue(isinstance(sdba, BaseDBArray))
+
+        # assemble shards of different sizes
+        dbpaths = []
+        for start, end in [(0, 10), (10, 70), (70, 100)]:
+            dbpaths.append(os.path.join(self.tempdir, self.DBTYPE,
+                                        'test_assemble_%d.db' % start))
+            DBArray.fromndarray(val[start:end], dbpaths[-1], self.DBTYPE)
+        sdba = ShardedDBArray.assemble(dbpaths, self.DBTYPE)
+        self._info_eq(sdba, val)
+        self._arr_eq(sdba.tondarray(), val)
+
+    def test_server(self):
+        """ Access arrays through `DBArrayServer`.
+        """
+        val = self.commdbs['float64']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_server.db')
+        dbarrays = {
+            'arr': DBArray.fromndarray(val, dbpath, self.DBTYPE),
+            'new': DBArray(dbpath + '.new', self.DBTYPE),
+            'sharded': ShardedDBArray.fromndarray(
+                val, [dbpath + '.s%d' % i for i in range(3)], self.DBTYPE,
+                'hash'),
+        }
+        dbarrays['sharded']['name'] = 'sharded'
+        sockpath = os.path.join(self.tempdir, self.DBTYPE, 'test_server.sock')
+        for address in [('127.0.0.1', 0), sockpath]:
+            server = DBArrayServer(address, dbarrays)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                dba = DBArray(server.url('arr'), 'remote')
+                self._info_eq(dba, val)
+                self._arr_eq(dba.tondarray(), val)
+                self._arr_eq(dba[[9, 3, 9]], val[[9, 3, 9]])
+                raws = dba.get_raw_rows(range(95, 105))
+                self.assertEqual(raws[5:], [None] * 5)
+                self._arr_eq(np.frombuffer(''.join(raws[:5]), val.dtype)
+                             .reshape(5, -1), val[95:])
+
+                # create array and write through the server
+                dba = DBArray(server.url('new'), 'remote')
+                dba.set_dtype(val.dtype)
+                dba.set_shape(val.shape)
+                dba['mean'] = val.mean(0)
+                with dba.buffered():
+                    dba.set_rows(range(val.shape[0]), val)
+                dba[7] = val[0]
+                dba = DBArray(server.url('new'), 'remote')
+                self._info_eq(dba, val)
+                self._arr_eq(dba['mean'], val.mean(0))
+                self._arr_eq(dba[7], val[0])
+                dba[7] = val[7]
+                # the served array sees the writes of the clients
+                self._info_eq(dbarrays['new'], val)
+                self._arr_eq(dbarrays['new'].tondarray(), val)
+                self._arr_eq(dbarrays['new']['mean'], val.mean(0))
+                dba['mean'] = val.mean(1)
+                self._arr_eq(dbarrays['new']['mean'], val.mean(1))
+
+                # a batch failing on the server leaves no partial write
+                items = [(pack('q', rid), np.zeros_like(val[rid]).tostring())
+                         for rid in range(val.shape[0])] * 6
+                self.assertRaises(Exception, dba._storage.set_row_multi,
+                                  items + [('bad', '')])
+                self._arr_eq(dbarrays['new'].tondarray(), val)
+
+                # sharded array
+                dba = DBArray(server.url('sharded'), 'remote')
+                self._info_eq(dba, val)
+                self.assertEqual(dba['name'], 'sharded')
+                self._arr_eq(dba.tondarray(), val)
+                with dba.buffered():
+                    dba[[3, 4]] = val[[4, 3]]
+                self._arr_eq(dbarrays['sharded'][[3, 4]], val[[4, 3]])
+                dba[[3, 4]] = val[[3, 4]]
+                self._arr_eq(dbarrays['sharded'].tondarray(), val)
+                self.assertRaises(Exception, dba.set_shape, (10, 256))
+
+                # concurrent clients, with the served array flushing its
+                # buffer meanwhile
+                errors = []
+
+                def client():
+                    try:
+                        cdba = DBArray(server.url('arr'), 'remote')
+                        for start in range(0, val.shape[0] - 7, 7):
+                            self._arr_eq(cdba[start:start + 7],
+                                         val[start:start + 7])
+                            v_rid = range(val.shape[0])[::-1]
+                            self._arr_eq(cdba[v_rid], val[v_rid])
+                    except Exception as err:
+                        errors.append(err)
+
+                def rewriter():
+                    try:
+                        cdba = DBArray(server.url('arr'), 'remote')
+                        for rid in range(val.shape[0]) * 3:
+                            cdba[rid] = val[rid]
+                    except Exception as err:
+                        errors.append(err)
+                clients = [threading.Thread(target=client) for i in range(8)]
+                clients.append(threading.Thread(target=rewriter))
+                with dbarrays['arr'].buffered(max_bytes=16 * val[0].nbytes):
+                    for cthread in clients:
+                        cthread.start()
+                    for cthread in clients:
+                        cthread.join()
+                self.assertEqual(errors, [])
+                self._arr_eq(dbarrays['arr'].tondarray(), val)
+
+                # concurrent writers are numbered by the served array
+                dbarrays['new'].set_tracking(True)
+                seq = dbarrays['new']._seq
+
+                def writer(start):
+                    try:
+                        cdba = DBArray(server.url('new'), 'remote')
+                        for rid in range(start, val.shape[0], 4):
+                            cdba[rid] = val[rid]
+                    except Exception as err:
+                        errors.append(err)
+                writers = [threading.Thread(target=writer, args=(start, ))
+                           for start in range(4)]
+                for cthread in writers:
+                    cthread.start()
+                for cthread in writers:
+                    cthread.join()
+                self.assertEqual(errors, [])
+                self.assertEqual(dbarrays['new']._seq, seq + val.shape[0])
+                changes = list(dbarrays['new'].changes_since(seq))
+                self.assertEqual(
+                    sorted(sum([v_rid for s, v_rid, r, f in changes], [])),
+                    range(val.shape[0]))
+
+                self.assertRaises(Exception, DBArray, server.url('none'),
+                                  'remote')
+            finally:
+                server.shutdown()
+                thread.join()
+
+    def test_resize(self):
+        """ Resize and compact.
+        """
+        val = self.commdbs['float64']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_resize.db')
+        dba = DBArray.fromndarray(val, dbpath, self.DBTYPE, sync=True)
+        dba.resize(60)
+        self.assertEqual(dba.shape, (60, val.shape[1]))
+        dba.resize(80)
+        self._arr_eq(dba[:60], val[:60])
+        self._arr_eq(dba[60:80], np.zeros((20, val.shape[1])))
+        self.assertEqual(dba._storage.get(pack('q', 70)), None)
+
+        # rewrite repeatedly, then compact
+        for i in range(5):
+            with dba.buffered():
+                dba.set_rows(range(80), val[:80] + i)
+        dba.compact()
+        self._arr_eq(dba.tondarray(), val[:80] + 4)
+        del dba
+        dba = DBArray(dbpath, self.DBTYPE)
+        self._info_eq(dba, val[:80])
+        self._arr_eq(dba.tondarray(), val[:80] + 4)
+
+        for partition in ['range', 'hash']:
+            dbpaths = [os.path.join(self.tempdir, self.DBTYPE,
+                                    'test_resize_%s_%d.db' % (partition, i))
+                       for i in range(3)]
+            sdba = ShardedDBArray.fromndarray(val, dbpaths, self.DBTYPE,
+                                              partition)
+            sdba.resize(50)
+            sdba.resize(70)
+            sdba.compact()
+            del sdba
+            sdba = ShardedDBArray(dbpaths, self.DBTYPE)
+            self.assertEqual(sdba.nrows, 70)
+            self._arr_eq(sdba[:50], val[:50])
+            self._arr_eq(sdba[50:70], np.zeros((20, val.shape[1])))
+
+    def test_changes(self):
+        """ Track changes and sync them to another array.
+        """
+        val = self.commdbs['int64']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_changes.db')
+        src = self._create_dba(dbpath, val.shape, val.dtype)
+        src.set_tracking(True)
+        src.set_rows(range(50), val[:50])
+        dst = self._create_dba(dbpath + '.dst', (0, val.shape[1]), val.dtype)
+
+        seq = dst.apply_changes(src.changes_since(0, batch_size=16))
+        self.assertEqual(seq, 50)
+        self.assertEqual(dst.nrows, 50)
+        self._arr_eq(dst.tondarray(), val[:50])
+
+        # only the delta is exported, once per row
+        with src.buffered():
+            src[10] = val[0]
+            src[70] = val[70]
+            src[10] = val[10] + 1
+        src[99] = val[99]
+        del src
+        src = DBArray(dbpath, self.DBTYPE)
+        self.assertTrue(src.tracking)
+        changes = list(src.changes_since(seq, batch_size=2))
+        self.assertEqual(
+            sorted(sum([v_rid for s, v_rid, r, f in changes], [])),
+            [10, 70, 99])
+        seq = dst.apply_changes(iter(changes))
+        self.assertEqual(seq, 54)
+        self.assertEqual(dst.nrows, 100)
+        self._arr_eq(dst[10], val[10] + 1)
+        self._arr_eq(dst[[70, 99]], val[[70, 99]])
+        self.assertEqual(list(src.changes_since(seq)), [])
+        self.assertEqual(dst.apply_changes(src.changes_since(seq)), None)
+
+        # internal records are apart from the attributes
+        src['seq'] = 'hello'
+        src['header'] = 'world'
+        self.assertRaises(ValueError, src.__setitem__, '__dbarray__/seq', 1)
+        self.assertRaises(KeyError, src.__getitem__, '__dbarray__/seq')
+        del src
+        src = DBArray(dbpath, self.DBTYPE)
+        self.assertEqual(src._seq, seq)
+        src[1] = val[1]
+        self.assertEqual(src['seq'], 'hello')
+        self.assertEqual(src['header'], 'world')
+        self._info_eq(src, val)
+        seq = dst.apply_changes(src.changes_since(seq))
+        self.assertEqual(seq, 55)
+
+        # the log keeps only the last write of each row
+        for i in range(20):
+            src[5] = val[i]
+        with src.buffered():
+            for i in range(20):
+                src[6] = val[i]
+        logkeys = src._storage.scan(LOG_PREFIX, LOG_STOP, 1000)
+        # one entry for each of rows 0-49, 70 and 99
+        self.assertEqual(len(logkeys), 52)
+        seq = dst.apply_changes(src.changes_since(seq))
+        self.assertEqual(seq, 95)
+        self._arr_eq(dst[[5, 6]], val[[19, 19]])
+
+        # truncated rows leave no log entries behind
+        src.resize(60)
+        self.assertEqual(len(src._storage.scan(LOG_PREFIX, LOG_STOP, 1000)),
+                         50)
+        src.resize(100)
+        src[70] = val[71]
+        src[70] = val[70]
+        self.assertEqual(len(src._storage.scan(LOG_PREFIX, LOG_STOP, 1000)),
+                         51)
+        changes = list(src.changes_since(seq))
+        self.assertEqual(sum([v_rid for s, v_rid, r, f in changes], []), [70])
+
+        # tracking enabled again continues after the logged writes
+        src.set_tracking(False)
+        src[3] = val[4]
+        del src
+        src = DBArray(dbpath, self.DBTYPE)
+        src.set_tracking(True)
+        src[3] = val[3]
+        changes = list(src.changes_since(seq))
+        self.assertEqual(sum([v_rid for s, v_rid, r, f in changes], []),
+                         [70, 3])
+        self.assertEqual(dst.apply_changes(iter(changes)), seq + 3)
+        self._arr_eq(dst[3], val[3:4])
+
+        # rows of another format are refused
+        other = self._create_dba(dbpath + '.other', val.shape, np.int32)
+        self.assertRaises(ValueError, other.apply_changes,
+                          src.changes_since(0))
+        other.set_shape((val.shape[0], val.shape[1] // 2, 2))
+        other.set_dtype(val.dtype)
+        self.assertRaises(ValueError, other.apply_changes,
+                          src.changes_since(0))
+
+        # sharded arrays sync with one sequence number per shard
+        for partition in ['range', 'hash']:
+            dbpaths = [os.path.join(self.tempdir, self.DBTYPE,
+                                    'test_changes_%s_%d.db' % (partition, i))
+                       for i in range(3)]
+            ssrc = ShardedDBArray(dbpaths, self.DBTYPE, partition)
+            ssrc.set_dtype(val.dtype)
+            ssrc.set_shape((60, val.shape[1]))
+            ssrc.set_tracking(True)
+            ssrc.set_rows(range(60), val[:60])
+            sdst = self._create_dba(dbpath + '.%s.dst' % partition,
+                                    (0, val.shape[1]), val.dtype)
+            seqs = sdst.apply_changes(ssrc.changes_since(0, batch_size=7))
+            self.assertEqual(list(seqs), [20, 20, 20])
+            self._arr_eq(sdst.tondarray(), val[:60])
+
+            ssrc.resize(val.shape[0])
+            ssrc[[3, 90]] = val[[4, 90]]
+            changes = list(ssrc.changes_since(seqs))
+            self.assertEqual(
+                sorted(sum([v_rid for s, v_rid, r, f in changes], [])),
+                [3, 90])
+            seqs = sdst.apply_changes(iter(changes))
+            self.assertEqual(sum(seqs), 62)
+            self._arr_eq(sdst[[3, 90]], val[[4, 90]])
+
+            # into a sharded array partitioned differently
+            sdst = ShardedDBArray(
+                [path + '.dst' for path in dbpaths[:2]], self.DBTYPE,
+                'hash' if partition == 'range' else 'range')
+            sdst.set_dtype(val.dtype)
+            sdst.set_shape((0, val.shape[1]))
+            self.assertEqual(list(sdst.apply_changes(ssrc.changes_since(0))),
+                             list(seqs))
+            self._arr_eq(sdst[[3, 90]], val[[4, 90]])
+            self._arr_eq(sdst[:60], ssrc[:60])
+            self.assertRaises(ValueError, list, ssrc.changes_since(5))
+            self.assertRaises(ValueError, list, ssrc.changes_since([0, 0]))
+
+    def test_open(self):
+        """ Open by marker file and legacy information keys.
+        """
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_open.db')
+        val = self.commdbs['float32']
+        dba = DBArray.fromndarray(val, dbpath, self.DBTYPE)
+        with open(os.path.join(dbpath, 'DBARRAY')) as mfile:
+            self.assertEqual(mfile.read(), self.DBTYPE)
+
+        # the marker wins over the requested type
+        del dba
+        othertype = 'lmdb' if self.DBTYPE == 'leveldb' else 'leveldb'
+        dba = DBArray(dbpath, othertype)
+        self._info_eq(dba, val)
+
+        # DB without header record
+        dba._storage.delete_multi([HEADER_KEY])
+        dba._storage.set('nrows', pack('q', val.shape[0]))
+        dba._storage.set('ncols', pack('q', val.shape[1]))
+        dba._storage.set('dtype', val.dtype.name)
+        os.remove(os.path.join(dbpath, 'DBARRAY'))
+        dba._storage = None
+        del dba
+        dba = DBArray(dbpath, self.DBTYPE)
+        self._info_eq(dba, val)
+        self._arr_eq(dba.tondarray(), val)
+
+    def test_buffered(self):
+        """ Buffered row writes.
+        """
+        for key, val in self.commdbs.iteritems():
+            dbpath = os.path.join(self.tempdir, self.DBTYPE,
+                                  'test_buffered_%s.db' % key)
+            dba = self._create_dba(dbpath, val.shape, val.dtype)
+
+            with dba.buffered(max_bytes=val[0].nbytes * 10):
+                # repeated writes are coalesced
+                dba[0] = val[1]
+                self._arr_eq(dba[0], val[1])
+                for rid in range(val.shape[0]):
+                    dba[rid] = val[rid]
+                    # pending rows are readable
+                    self._arr_eq(dba[rid], val[rid])
+                self.assertTrue(len(dba._wbuf) < 10)
+
+            self.assertEqual(dba._wbuf, None)
+
+            # pending rows are discarded if the block fails
+            def fail(dba):
+                with dba.buffered():
+                    dba[0] = val[1]
+                    raise ValueError('failed')
+            self.assertRaises(ValueError, fail, dba)
+            self.assertEqual(dba._wbuf, None)
+            self._arr_eq(dba[0], val[0])
+
+            del dba
+            dba = DBArray(dbpath, self.DBTYPE)
+            self._arr_eq(dba.tondarray(), val)
+
     def test_set_attr(self):
         for key, val in self.commdbs.iteritems():
             dbpath = os.path.join(self.tempdir, self.DBTYPE,
@@ -238,6 +848,125 @@ class TestDBArray_LMDB(unittest.TestCase, CommTestDBArray):
     def tearDownClass(cls):
         os.system('rm -r %s' % cls.tempdir)
 
+    def test_map_growth(self):
+        """ Grow the map when it is full.
+        """
+        val = self.commdbs['float64']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_growth.db')
+        dba = DBArray(dbpath, self.DBTYPE, map_size=2**16)
+        dba.set_dtype(val.dtype)
+        dba.set_shape(val.shape)
+        with dba.buffered():
+            dba.set_rows(range(val.shape[0]), val)
+        self._arr_eq(dba.tondarray(), val)
+        self.assertTrue(dba._storage.env.info()['map_size'] > 2**16)
+
+        dbpath = os.path.join(self.tempdir, self.DBTYPE, 'test_nogrowth.db')
+        dba = DBArray(dbpath, self.DBTYPE, map_size=2**16, grow=False)
+        dba.set_dtype(val.dtype)
+        dba.set_shape(val.shape)
+        self.assertRaises(lmdb.MapFullError, dba.set_rows,
+                          range(val.shape[0]), val)
+
+    def test_compact_handles(self):
+        """ Compact while other handles of the DB are open and written.
+        """
+        val = self.commdbs['float64']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE,
+                              'test_compact_handles.db')
+        dba1 = DBArray.fromndarray(val, dbpath, self.DBTYPE)
+        dba2 = DBArray(dbpath, self.DBTYPE)
+
+        errors = []
+
+        def writer(dba):
+            try:
+                for rid in range(val.shape[0]):
+                    dba[rid] = val[rid] + 1
+            except Exception as err:
+                errors.append(err)
+        thread = threading.Thread(target=writer, args=(dba2, ))
+        thread.start()
+        for i in range(5):
+            dba1.compact()
+        thread.join()
+        self.assertEqual(errors, [])
+
+        # no write is lost and every handle sees the compacted DB
+        self._arr_eq(dba1.tondarray(), val + 1)
+        self._arr_eq(dba2.tondarray(), val + 1)
+        dba2[0] = val[0]
+        self._arr_eq(dba1[0], val[0:1])
+        dba1.compact()
+        self._arr_eq(dba2.tondarray()[1:], val[1:] + 1)
+        self._arr_eq(DBArray(dbpath, self.DBTYPE)[0], val[0:1])
+
+    def test_compact_readers(self):
+        """ Compact while other handles of the DB are read by threads.
+        """
+        val = self.commdbs['float64']
+        dbpath = os.path.join(self.tempdir, self.DBTYPE,
+                              'test_compact_readers.db')
+        dba1 = DBArray.fromndarray(val, dbpath, self.DBTYPE)
+        dba2 = DBArray(dbpath, self.DBTYPE)
+
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    self._arr_eq(dba2[[90, 3, 50]], val[[90, 3, 50]])
+            except Exception as err:
+                errors.append(err)
+        readers = [threading.Thread(target=reader) for i in range(4)]
+        for thread in readers:
+            thread.start()
+        try:
+            for i in range(50):
+                dba1.compact()
+        finally:
+            done.set()
+            for thread in readers:
+                thread.join()
+        self.assertEqual(errors, [])
+        self._arr_eq(dba2.tondarray(), val)
+
+    def test_growth_readers(self):
+        """ Grow the map while other handles of the DB are read by threads.
+        """
+        val = np.tile(self.commdbs['float64'], (8, 1))
+        dbpath = os.path.join(self.tempdir, self.DBTYPE,
+                              'test_growth_readers.db')
+        dba1 = DBArray(dbpath, self.DBTYPE, map_size=2**17)
+        dba1.set_dtype(val.dtype)
+        dba1.set_shape(val.shape)
+        dba1[0] = val[0]
+        dba2 = DBArray(dbpath, self.DBTYPE)
+
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    self._arr_eq(dba2[[0] * 50], val[[0] * 50])
+            except Exception as err:
+                errors.append(err)
+        readers = [threading.Thread(target=reader) for i in range(4)]
+        for thread in readers:
+            thread.start()
+        try:
+            for rid in range(1, val.shape[0]):
+                dba1[rid] = val[rid]
+        finally:
+            done.set()
+            for thread in readers:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(dba1._storage.env.info()['map_size'] > 2**17)
+        self._arr_eq(dba2.tondarray(), val)
+
     def test_multi_handle(self):
         """ Test the case of open multiple handle for the same database.
 